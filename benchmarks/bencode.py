@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# time listing the files of big torrents, mapped and decoded in place,
+# against reading them and decoding with copies of every string
+#
+#   python3 benchmarks/bencode.py [FILES] [PIECES_MB]
+#
+# the torrent is generated in a temporary directory first
+import os
+import sys
+import time
+import hashlib
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import pirate.bencode
+import pirate.torrent
+
+
+# a plain recursive decoder that slices bytes, for comparison
+def copying_decode(data, pos=0):
+    c = data[pos:pos + 1]
+    if c == b'i':
+        end = data.index(b'e', pos)
+        return int(data[pos + 1:end]), end + 1
+    if c == b'l':
+        items = []
+        pos += 1
+        while data[pos:pos + 1] != b'e':
+            item, pos = copying_decode(data, pos)
+            items.append(item)
+        return items, pos + 1
+    if c == b'd':
+        items = {}
+        pos += 1
+        while data[pos:pos + 1] != b'e':
+            key, pos = copying_decode(data, pos)
+            items[key], pos = copying_decode(data, pos)
+        return items, pos + 1
+    colon = data.index(b':', pos)
+    end = colon + 1 + int(data[pos:colon])
+    return data[colon + 1:end], end
+
+
+def copying_info(f):
+    data = f.read()
+    info = copying_decode(data)[0][b'info']
+    name = info[b'name'].decode('utf-8', 'replace')
+    files = [('/'.join([name] + [p.decode('utf-8', 'replace')
+                                 for p in entry[b'path']]), entry[b'length'])
+             for entry in info[b'files']]
+    # the info dict has to be encoded again to hash it
+    info_hash = hashlib.sha1(pirate.bencode.encode(info)).hexdigest()
+    return {'files': files, 'info_hash': int(info_hash, 16)}
+
+
+def make_torrent(files, pieces_mb):
+    info = {
+        'name': 'benchmark',
+        'piece length': 1 << 18,
+        'pieces': os.urandom(pieces_mb << 20),
+        'files': [{'length': 1000 + i,
+                   'path': ['disc {}'.format(i // 100),
+                            'track {:05}.flac'.format(i)]}
+                  for i in range(files)],
+    }
+    return pirate.bencode.encode({'announce': 'udp://tracker:80',
+                                  'info': info})
+
+
+def best(fn, path, runs=5):
+    times = []
+    for _ in range(runs):
+        with open(path, 'rb') as f:
+            start = time.perf_counter()
+            info = fn(f)
+            times.append(time.perf_counter() - start)
+    return min(times), info
+
+
+def main():
+    files = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    pieces_mb = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'benchmark.torrent')
+        with open(path, 'wb') as f:
+            f.write(make_torrent(files, pieces_mb))
+        size = os.path.getsize(path)
+        print('{} files, {} torrent'.format(
+            files, pirate.torrent.pretty_size(size)))
+
+        results = {}
+        for name, fn in [('mmap', pirate.bencode.read_info),
+                         ('copying', copying_info)]:
+            elapsed, info = best(fn, path)
+            results[name] = info
+            print('{:8} {:8.1f} ms {:8.1f} MB/s'.format(
+                name, elapsed * 1e3, size / elapsed / 1e6))
+        assert results['mmap']['files'] == results['copying']['files']
+        assert results['mmap']['info_hash'] == results['copying']['info_hash']
+
+
+if __name__ == '__main__':
+    main()
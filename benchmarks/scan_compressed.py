@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# compare the scan throughput of a dump with its compressed copies
+#
+#   python3 benchmarks/scan_compressed.py DUMP [QUERY]
+#
+# the copies are written to a temporary directory first, only the scans
+# are timed
+import os
+import sys
+import time
+import gzip
+import lzma
+import bz2
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import pirate.local
+
+
+formats = [
+    ('', open),
+    ('.gz', gzip.open),
+    ('.xz', lzma.open),
+    ('.bz2', bz2.open),
+]
+
+
+def main():
+    dump = sys.argv[1]
+    query = sys.argv[2] if len(sys.argv) > 2 else 'ubuntu'
+    size = os.path.getsize(dump)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for ext, opener in formats:
+            path = os.path.join(tmp, 'dump.csv' + ext)
+            with open(dump, 'rb') as src, opener(path, 'wb') as dst:
+                shutil.copyfileobj(src, dst, pirate.local.block_size)
+
+            start = time.perf_counter()
+            rows = pirate.local.scan(path, query)
+            elapsed = time.perf_counter() - start
+            print('{:5} {:>10} {:8.2f} s {:8.1f} MB/s {:6} rows'.format(
+                ext or 'plain',
+                pirate.local.sizeof_fmt(os.path.getsize(path)),
+                elapsed, size / elapsed / 1e6, len(rows)))
+
+
+if __name__ == '__main__':
+    main()
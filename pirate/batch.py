@@ -0,0 +1,76 @@
+import collections
+
+import pirate.local
+
+
+# Aho-Corasick automaton finding all the patterns in a text in one pass
+class Automaton:
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+
+        # trie of the patterns, out[state] are the patterns ending there
+        goto = [{}]
+        out = [set()]
+        for i, pattern in enumerate(self.patterns):
+            state = 0
+            for char in pattern:
+                if char not in goto[state]:
+                    goto.append({})
+                    out.append(set())
+                    goto[state][char] = len(goto) - 1
+                state = goto[state][char]
+            out[state].add(i)
+
+        # breadth first, every state falls back to the longest suffix
+        # that is also in the trie. with the transitions of the fallback
+        # copied in, matching never has to follow failure links
+        self.delta = [dict(goto[0])]
+        self.delta.extend({} for _ in goto[1:])
+        fail = [0] * len(goto)
+        queue = collections.deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            self.delta[state] = dict(self.delta[fail[state]])
+            for char, child in goto[state].items():
+                fail[child] = self.delta[fail[state]].get(char, 0)
+                out[child] |= out[fail[child]]
+                self.delta[state][char] = child
+                queue.append(child)
+        self.out = [frozenset(patterns) for patterns in out]
+
+    # the indexes of the patterns found in text
+    def search(self, text):
+        delta = self.delta
+        out = self.out
+        found = set(out[0])
+        state = 0
+        for char in text:
+            state = delta[state].get(char, 0)
+            if out[state]:
+                found |= out[state]
+        return found
+
+
+# (query, result) for every row matching any of the queries, reading
+# the dump once. a row matching several queries comes once per query,
+# in the order the queries were given
+def search(db, queries):
+    queries = list(queries)
+    # positions of the queries looking for each pattern
+    patterns = {}
+    for i, query in enumerate(queries):
+        patterns.setdefault(query.lower(), []).append(i)
+    automaton = Automaton(patterns)
+    positions = list(patterns.values())
+
+    with pirate.local.open_dump(db) as f:
+        for line in f:
+            row = pirate.local.parse_line(line)
+            if row is None:
+                continue
+            found = automaton.search(row[2].lower())
+            if not found:
+                continue
+            result = pirate.local.build_result(row)
+            for i in sorted(i for p in found for i in positions[p]):
+                yield queries[i], result
@@ -0,0 +1,177 @@
+import mmap
+import hashlib
+
+
+# nesting deeper than this is refused instead of overflowing the stack
+max_depth = 64
+
+
+# bencoded data is decoded in place: strings are memoryview slices of
+# data, so the pieces of a torrent are never copied. data is anything
+# with find(), like bytes or an mmap
+def decode(data):
+    with memoryview(data) as view:
+        value, end = decode_at(data, view, 0, 0)
+        check_end(view, end)
+        return value
+
+
+def check_end(view, end):
+    if end != len(view):
+        raise ValueError('invalid bencode: trailing data at {}'.format(end))
+
+
+# the value starting at pos and the position after it
+def decode_at(data, view, pos, depth):
+    if depth > max_depth:
+        raise ValueError('invalid bencode: nested too deep')
+    if pos >= len(view):
+        raise ValueError('invalid bencode: truncated')
+    c = view[pos]
+    if c == 0x69:  # i
+        end = data.find(b'e', pos + 1)
+        return parse_int(data, pos + 1, end), end + 1
+    if 0x30 <= c <= 0x39:  # 0-9
+        return decode_string(data, view, pos)
+    if c == 0x6c:  # l
+        items = []
+        pos += 1
+        while pos < len(view) and view[pos] != 0x65:  # e
+            item, pos = decode_at(data, view, pos, depth + 1)
+            items.append(item)
+        return items, closing(view, pos)
+    if c == 0x64:  # d
+        items, _, end = decode_dict(data, view, pos, depth)
+        return items, end
+    raise ValueError('invalid bencode: unexpected {!r} at {}'.format(
+        chr(c), pos))
+
+
+# the dict at pos with its keys as bytes, where each value starts and
+# ends, and the position after it
+def decode_dict(data, view, pos, depth):
+    items = {}
+    spans = {}
+    pos += 1
+    while pos < len(view) and view[pos] != 0x65:  # e
+        key, start = decode_string(data, view, pos)
+        key = bytes(key)
+        items[key], pos = decode_at(data, view, start, depth + 1)
+        spans[key] = (start, pos)
+    return items, spans, closing(view, pos)
+
+
+def closing(view, pos):
+    if pos >= len(view):
+        raise ValueError('invalid bencode: truncated')
+    return pos + 1
+
+
+def parse_int(data, start, end):
+    if end < 0:
+        raise ValueError('invalid bencode: truncated')
+    digits = data[start:end]
+    # no sign and no leading zeros, except for 0 itself
+    if digits.isdigit() and (digits[0] != 0x30 or len(digits) == 1):
+        return int(digits)
+    if digits[:1] == b'-' and digits[1:].isdigit() and digits[1] != 0x30:
+        return int(digits)
+    raise ValueError('invalid bencode: bad integer at {}'.format(start))
+
+
+def decode_string(data, view, pos):
+    colon = data.find(b':', pos)
+    length = parse_int(data, pos, colon)
+    start = colon + 1
+    if length < 0 or start + length > len(view):
+        raise ValueError('invalid bencode: truncated')
+    return view[start:start + length], start + length
+
+
+def text(value):
+    if not isinstance(value, memoryview):
+        raise TypeError('not a string')
+    return bytes(value).decode('utf-8', 'replace')
+
+
+# the bencoding of ints, bytes, views, strings, lists and dicts of them
+def encode(value):
+    out = []
+    encode_into(value, out)
+    return b''.join(out)
+
+
+def encode_into(value, out):
+    if isinstance(value, int):
+        out.append(b'i%de' % value)
+    elif isinstance(value, (bytes, memoryview, str)):
+        if isinstance(value, str):
+            value = value.encode('utf-8')
+        out.append(b'%d:' % len(value))
+        out.append(value)
+    elif isinstance(value, list):
+        out.append(b'l')
+        for item in value:
+            encode_into(item, out)
+        out.append(b'e')
+    elif isinstance(value, dict):
+        out.append(b'd')
+        items = [(k.encode('utf-8') if isinstance(k, str) else k, v)
+                 for k, v in value.items()]
+        for key, item in sorted(items):
+            encode_into(key, out)
+            encode_into(item, out)
+        out.append(b'e')
+    else:
+        raise TypeError('cannot bencode {!r}'.format(value))
+
+
+# the name, piece length, files as (path, length) and info hash of a
+# torrent. the hash is the sha1 of the info dict exactly as it is in data
+def torrent_info(data):
+    with memoryview(data) as view:
+        if not len(view) or view[0] != 0x64:  # d
+            raise ValueError('invalid torrent: not a dict')
+        top, spans, end = decode_dict(data, view, 0, 0)
+        check_end(view, end)
+        info = top.get(b'info')
+        if not isinstance(info, dict):
+            raise ValueError('invalid torrent: no info dict')
+        start, end = spans[b'info']
+        info_hash = int(hashlib.sha1(view[start:end]).hexdigest(), 16)
+
+        try:
+            name = text(info.get(b'name.utf-8', info[b'name']))
+            if b'files' in info:
+                files = []
+                for entry in info[b'files']:
+                    path = entry.get(b'path.utf-8', entry.get(b'path'))
+                    files.append(('/'.join([name] + [text(p) for p in path]),
+                                  int(entry[b'length'])))
+            else:
+                files = [(name, int(info[b'length']))]
+        except (KeyError, TypeError, AttributeError):
+            raise ValueError('invalid torrent: bad file list')
+        return {
+            'name': name,
+            'piece_length': info.get(b'piece length'),
+            'files': files,
+            'info_hash': info_hash,
+        }
+
+
+# torrent_info of an open .torrent file, mapped instead of read
+def read_info(f):
+    try:
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except ValueError:
+        raise ValueError('invalid torrent: empty file')
+    try:
+        return torrent_info(m)
+    finally:
+        try:
+            m.close()
+        except BufferError:
+            # a traceback still holds views of it, it is closed when
+            # they are freed
+            pass
@@ -0,0 +1,67 @@
+import os
+import json
+import time
+import tempfile
+
+
+# small json files in the cache directory, each mapping keys to values
+# and the time they were stored. a directory of None disables caching
+
+def path(directory, name):
+    return os.path.join(directory, name + '.json')
+
+
+def load(directory, name):
+    if directory is None:
+        return {}
+    try:
+        with open(path(directory, name)) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+def save(directory, name, data):
+    if directory is None:
+        return
+    try:
+        os.makedirs(directory, exist_ok=True)
+        # several threads may save at once, each writes its own file
+        with tempfile.NamedTemporaryFile('w', dir=directory,
+                                         suffix='.tmp', delete=False) as f:
+            json.dump(data, f)
+        # temporary files are private, other users may share the cache
+        os.chmod(f.name, 0o644)
+        os.replace(f.name, path(directory, name))
+    except OSError:
+        # the cache is only an optimization
+        pass
+
+
+# the value stored under key and its age in seconds, or (None, None)
+def lookup(directory, name, key):
+    entry = load(directory, name).get(key)
+    if entry is None:
+        return None, None
+    return entry['value'], time.time() - entry['time']
+
+
+# the value stored under key if it is younger than ttl seconds
+def get(directory, name, key, ttl):
+    value, age = lookup(directory, name, key)
+    if value is None or age >= ttl:
+        return None
+    return value
+
+
+def put(directory, name, key, value):
+    data = load(directory, name)
+    data[key] = {'value': value, 'time': time.time()}
+    save(directory, name, data)
+
+
+def delete(directory, name, key):
+    data = load(directory, name)
+    if data.pop(key, None) is not None:
+        save(directory, name, data)
@@ -0,0 +1,415 @@
+import os
+import re
+import array
+import base64
+import bisect
+import struct
+import shutil
+import heapq
+import math
+import collections
+
+import pirate.local
+import pirate.sidecar
+
+
+version = 4
+
+# info hash and byte offset of its row in the dump
+hash_record = struct.Struct('<20sQ')
+
+# appends add a segment each, past this many the index is rebuilt
+max_segments = 16
+
+# bm25 parameters
+k1 = 1.2
+b = 0.75
+
+token_re = re.compile(r'\w+')
+
+
+def tokenize(text):
+    return token_re.findall(text.lower())
+
+
+def index_path(db):
+    return db + '.index'
+
+
+# the index is a directory next to the database with:
+#   offsets.bin      byte offset of every row in the dump (uint64)
+#   lengths.bin      number of tokens in the title of every row (uint16)
+#   meta.json        what the index was built from and its segments
+# and for each segment, covering the rows appended by one build:
+#   N.terms.bin      all the tokens, sorted and concatenated (utf-8)
+#   N.terms.idx      (start, end, first posting, postings count,
+#                    highest frequency, shortest title) per token
+#   N.postings.bin   row numbers containing each token (uint32)
+#   N.freqs.bin      times the token is in each of those rows (uint8)
+#   N.hashes.bin     hash_records sorted by info hash
+def build(db):
+    path = index_path(db)
+    meta = pirate.sidecar.read_meta(path)
+    with open(db, 'rb') as f:
+        start = pirate.sidecar.resume_offset(meta, f, version)
+        if start and len(meta['segments']) < max_segments:
+            return add_segment(path, meta, f, start)
+
+        tmp = path + '.tmp'
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        for name in ['offsets.bin', 'lengths.bin']:
+            with open(os.path.join(tmp, name), 'wb'):
+                pass
+        meta = {'version': version, 'rows': 0, 'tokens': 0, 'segments': []}
+        rows = add_segment(tmp, meta, f, 0)
+
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(tmp, path)
+    return rows
+
+
+# index the rows from offset on into a new segment and record it in meta
+def add_segment(path, meta, f, offset):
+    # token -> [row numbers, frequencies, shortest title]
+    postings = {}
+    offsets = array.array('Q')
+    lengths = array.array('H')
+    hashes = []
+    end = [offset]
+    first_doc = meta['rows']
+    for row_offset, line in pirate.sidecar.read_lines(f, offset, end):
+        row = pirate.local.parse_line(line)
+        if row is None:
+            continue
+        doc = first_doc + len(offsets)
+        tokens = collections.Counter(tokenize(row[2]))
+        length = min(sum(tokens.values()), 0xffff)
+        offsets.append(row_offset)
+        lengths.append(length)
+        hashes.append((base64.b64decode(row[1]), row_offset))
+        for token, freq in tokens.items():
+            if token not in postings:
+                postings[token] = [array.array('I'), array.array('B'),
+                                   length]
+            posting = postings[token]
+            posting[0].append(doc)
+            posting[1].append(min(freq, 0xff))
+            posting[2] = min(posting[2], length)
+
+    if offsets:
+        name = str(len(meta['segments']))
+        write_segment(path, name, postings, hashes)
+        meta['segments'].append(name)
+
+    # a build that died half way may have left rows past the recorded
+    # ones behind
+    columns = [('offsets.bin', offsets), ('lengths.bin', lengths)]
+    for name, values in columns:
+        with open(os.path.join(path, name), 'r+b') as out:
+            out.truncate(first_doc * values.itemsize)
+            out.seek(0, os.SEEK_END)
+            values.tofile(out)
+
+    meta['rows'] = first_doc + len(offsets)
+    meta['tokens'] += sum(lengths)
+    meta.update(pirate.sidecar.dump_state(f, end[0]))
+    pirate.sidecar.write_meta(path, meta)
+    return len(offsets)
+
+
+def write_segment(path, name, postings, hashes):
+    def segment_file(suffix):
+        return open(os.path.join(path, name + suffix), 'wb')
+
+    terms = array.array('Q')
+    with segment_file('.terms.bin') as blob, \
+            segment_file('.postings.bin') as post, \
+            segment_file('.freqs.bin') as freqs:
+        start = 0
+        first = 0
+        for token, (docs, tfs, shortest) in sorted(
+                (k.encode('utf-8'), v) for k, v in postings.items()):
+            terms.extend((start, start + len(token), first, len(docs),
+                          max(tfs), shortest))
+            blob.write(token)
+            docs.tofile(post)
+            tfs.tofile(freqs)
+            start += len(token)
+            first += len(docs)
+
+    with segment_file('.terms.idx') as f:
+        terms.tofile(f)
+
+    hashes.sort()
+    with segment_file('.hashes.bin') as f:
+        for info_hash, row in hashes:
+            f.write(hash_record.pack(info_hash, row))
+
+
+# the meta of the index of db if it can be used
+def current_meta(db):
+    meta = pirate.sidecar.read_meta(index_path(db))
+    if meta is None or meta.get('version') != version:
+        return None
+    if not pirate.sidecar.is_fresh(meta, db):
+        return None
+    return meta
+
+
+def open_index(db):
+    meta = current_meta(db)
+    if meta is None:
+        return None
+    return Index(db, index_path(db), meta)
+
+
+class Segment(pirate.sidecar.Mapped):
+    term_size = 6
+
+    def __init__(self, path, name):
+        super().__init__(path)
+        self.terms = self.map(name + '.terms.idx', 'Q')
+        self.blob = self.map(name + '.terms.bin', 'B')
+        self.postings = self.map(name + '.postings.bin', 'I')
+        self.freqs = self.map(name + '.freqs.bin', 'B')
+        self.hashes = self.map(name + '.hashes.bin', 'B')
+
+    def token(self, i):
+        i *= self.term_size
+        return self.blob[self.terms[i]:self.terms[i + 1]].tobytes()
+
+    # binary search the sorted lexicon for the entry of a token
+    def term(self, token):
+        token = token.encode('utf-8')
+        lo, hi = 0, len(self.terms) // self.term_size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.token(mid) < token:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == len(self.terms) // self.term_size:
+            return None
+        if self.token(lo) != token:
+            return None
+        return self.terms[lo*self.term_size:(lo + 1)*self.term_size]
+
+    def lookup(self, token):
+        term = self.term(token)
+        if term is None:
+            return None
+        return self.postings[term[2]:term[2] + term[3]]
+
+    # rows with a token that contains token, like a scan would find them.
+    # the lexicon is searched as one blob, a hit that runs past the end
+    # of its token is a hit across two tokens and doesn't count
+    def containing(self, token):
+        needle = token.encode('utf-8')
+        blob = self.blob.obj
+        starts = self.terms[0::self.term_size]
+        lists = []
+        pos = blob.find(needle)
+        while pos != -1:
+            i = bisect.bisect_right(starts, pos) - 1
+            term = self.terms[i*self.term_size:(i + 1)*self.term_size]
+            if pos + len(needle) <= term[1]:
+                lists.append(self.postings[term[2]:term[2] + term[3]])
+                pos = blob.find(needle, term[1])
+            else:
+                pos = blob.find(needle, pos + 1)
+        if len(lists) <= 1:
+            return lists[0] if lists else None
+        return sorted(set().union(*lists))
+
+    def candidates(self, tokens):
+        lists = []
+        for token in set(tokens):
+            docs = self.containing(token)
+            if docs is None:
+                return
+            lists.append(docs)
+        if not lists:
+            return
+        lists.sort(key=len)
+        for doc in lists[0]:
+            for other in lists[1:]:
+                i = bisect.bisect_left(other, doc)
+                if i == len(other) or other[i] != doc:
+                    break
+            else:
+                yield doc
+
+    # binary search the sorted hashes, returns the row offset or None
+    def find(self, info_hash):
+        size = hash_record.size
+        lo, hi = 0, len(self.hashes) // size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.hashes[mid*size:mid*size + 20].tobytes() < info_hash:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == len(self.hashes) // size:
+            return None
+        found, offset = hash_record.unpack(
+            self.hashes[lo*size:(lo + 1)*size])
+        if found != info_hash:
+            return None
+        return offset
+
+
+class Index(pirate.sidecar.Mapped):
+    def __init__(self, db, path, meta):
+        super().__init__(path)
+        self.db = db
+        self.meta = meta
+        self.offsets = self.map('offsets.bin', 'Q')
+        self.lengths = self.map('lengths.bin', 'H')
+        self.segments = [Segment(path, name) for name in meta['segments']]
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+        super().close()
+
+    def row(self, offset):
+        with open(self.db, 'rb') as f:
+            f.seek(offset)
+            return pirate.local.parse_line(f.readline())
+
+    # segments hold consecutive rows, so their candidates come in order
+    def candidates(self, tokens):
+        for segment in self.segments:
+            yield from segment.candidates(tokens)
+
+    # rows containing every word of the query, or words that contain
+    # them, checked against the same substring test as a full scan. a
+    # query without any word can't be answered from the index
+    def search(self, query):
+        with open(self.db, 'rb') as f:
+            for doc in self.candidates(tokenize(query)):
+                f.seek(self.offsets[doc])
+                row = pirate.local.parse_line(f.readline())
+                if row is not None and query in row[2].lower():
+                    yield row
+
+    # bm25 ranked rows containing any word of the query, best first.
+    # the postings are walked WAND style: rows that can't beat the
+    # count-th best score so far are skipped without being scored.
+    # accept can reject rows before they take a place in the top
+    def rank(self, query, count, accept=None):
+        tokens = set(tokenize(query))
+        rows = self.meta['rows']
+        if not tokens or not rows or count == 0:
+            return []
+        average = self.meta['tokens'] / rows
+
+        terms = []
+        for token in tokens:
+            found = [(segment, segment.term(token))
+                     for segment in self.segments]
+            found = [(segment, term) for segment, term in found if term]
+            freq = sum(term[3] for _, term in found)
+            if freq:
+                idf = math.log(1 + (rows - freq + 0.5) / (freq + 0.5))
+                terms.append((found, idf))
+
+        top = []
+        for segment in self.segments:
+            cursors = []
+            for found, idf in terms:
+                for other, term in found:
+                    if other is segment:
+                        cursors.append(Cursor(segment, term, idf, average))
+            self.wand(cursors, average, top, count, accept)
+
+        with open(self.db, 'rb') as f:
+            results = []
+            for score, doc in sorted(top, reverse=True):
+                f.seek(self.offsets[-doc])
+                results.append(pirate.local.parse_line(f.readline()))
+            return results
+
+    def wand(self, cursors, average, top, count, accept):
+        # top is a heap of (score, -row) so the worst of the kept rows is
+        # first and the lower row wins ties
+        def threshold():
+            return top[0][0] if len(top) >= count else 0
+
+        while True:
+            cursors = [c for c in cursors if c.doc is not None]
+            cursors.sort(key=lambda c: c.doc)
+
+            # the first row that could make it into the top if it
+            # contains every word up to here
+            bound = 0
+            pivot = None
+            for i, cursor in enumerate(cursors):
+                bound += cursor.bound
+                if bound > threshold():
+                    pivot = i
+                    break
+            if pivot is None:
+                return
+            doc = cursors[pivot].doc
+
+            if cursors[0].doc != doc:
+                for cursor in cursors[:pivot]:
+                    cursor.advance(doc)
+                continue
+
+            length = self.lengths[doc]
+            score = 0
+            for cursor in cursors:
+                if cursor.doc != doc:
+                    break
+                score += cursor.score(length)
+                cursor.advance(doc + 1)
+
+            entry = (score, -doc)
+            if len(top) < count or entry > top[0]:
+                if accept is not None and not accept(
+                        self.row(self.offsets[doc])):
+                    continue
+                if len(top) < count:
+                    heapq.heappush(top, entry)
+                else:
+                    heapq.heapreplace(top, entry)
+
+    # the first row with the info hash, or None
+    def find(self, info_hash):
+        for segment in self.segments:
+            offset = segment.find(info_hash)
+            if offset is not None:
+                return self.row(offset)
+        return None
+
+
+# walks the postings of a token in one segment
+class Cursor:
+    def __init__(self, segment, term, idf, average):
+        first, count, freq, shortest = term[2], term[3], term[4], term[5]
+        self.docs = segment.postings[first:first + count]
+        self.freqs = segment.freqs[first:first + count]
+        self.idf = idf
+        self.average = average
+        self.pos = 0
+        # no row of this segment can score higher for the token
+        self.bound = self.weight(freq, shortest)
+
+    @property
+    def doc(self):
+        if self.pos < len(self.docs):
+            return self.docs[self.pos]
+        return None
+
+    def advance(self, doc):
+        self.pos = bisect.bisect_left(self.docs, doc, self.pos)
+
+    def weight(self, freq, length):
+        norm = k1 * (1 - b + b * length / self.average)
+        return self.idf * freq * (k1 + 1) / (freq + norm)
+
+    def score(self, length):
+        return self.weight(self.freqs[self.pos], length)
@@ -1,6 +1,21 @@
 import urllib.parse as parse
 import base64
 import csv
+import re
+import mmap
+import os
+import calendar
+import heapq
+import functools
+import itertools
+import concurrent.futures
+import gzip
+import lzma
+import bz2
+
+import pirate.index
+import pirate.store
+
 
 # this is used to remove null bytes from the input stream because
 # apparently they exist
@@ -16,30 +31,323 @@ def sizeof_fmt(num, suffix='B'):
         num /= 1024.0
     return "%.1f %s%s" % (num, 'Yi', suffix)
 
-def search(db, terms):
-    with open(db, 'r') as f:
-        results = []
+months = {name: i for i, name in enumerate(
+    ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+     'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'], 1)}
+
+# dates look like 2018-May-14 11:05:31, returns a unix timestamp
+def parse_date(date):
+    day, clock = date.split(' ')
+    year, month, day = day.split('-')
+    hour, minute, second = clock.split(':')
+    return calendar.timegm((int(year), months[month], int(day),
+                            int(hour), int(minute), int(second)))
+
+# whether low <= value < high, None means unbounded
+def within(value, bounds):
+    if bounds is None:
+        return True
+    low, high = bounds
+    return ((low is None or value >= low) and
+            (high is None or value < high))
+
+# parse a single raw line of the dump, returns None for comments
+# and blank lines
+def parse_line(line):
+    if isinstance(line, bytes):
+        line = line.decode('utf-8')
+    line = line.replace("\0", "").rstrip('\r\n')
+    if not line or line[0] == '#':
+        return None
+    return next(csv.reader([line], delimiter=';'))
+
+# info hashes come as 40 hex or 32 base32 characters, or in a magnet link
+def parse_hash(text):
+    match = re.search(r'(?:btih:)?\b([0-9a-fA-F]{40}|[2-7a-zA-Z]{32})\b',
+                      text.strip())
+    if not match:
+        raise ValueError('invalid info hash: ' + text.strip())
+    value = match.group(1)
+    if len(value) == 40:
+        return base64.b16decode(value.upper())
+    return base64.b32decode(value.upper())
+
+def build_result(row):
+    # 0 is date in rfc 3339 format
+    # 1 magnet link hash
+    # 2 is title
+    # 3 is size in bytes
+    return {
+        'name': row[2],
+        'date': row[0],
+        'size': sizeof_fmt(int(row[3])),
+        'magnet':
+            'magnet:?xt=urn:btih:' +
+            base64.b16encode(base64.b64decode(row[1])).decode('utf-8') +
+            '&dn=' +
+            parse.quote(row[2]),
+        }
+
+# the dump is scanned in line aligned blocks of about this many bytes
+block_size = 1 << 24
+
+# compressed dumps are decompressed on the fly while scanning
+openers = {
+    '.gz': gzip.open,
+    '.xz': lzma.open,
+    '.bz2': bz2.open,
+}
+
+def is_compressed(db):
+    return os.path.splitext(db)[1].lower() in openers
+
+# open the dump for reading, decompressing it if needed
+def open_dump(db, mode='rb'):
+    opener = openers.get(os.path.splitext(db)[1].lower(), open)
+    return opener(db, mode)
+
+def scan_text(db, query):
+    with open_dump(db, 'rt') as f:
         reader = csv.reader(replace_iter(f), delimiter=';')
         for row in reader:
             # skip comments
             if row[0][0] == '#':
                 continue
-            # 0 is date in rfc 3339 format
-            # 1 magnet link hash
-            # 2 is title
-            # 3 is size in bytes
-            if ' '.join(terms).lower() in row[2].lower():
-                result = {
-                    'date': row[0],
-                    'size': sizeof_fmt(int(row[3])),
-                    'magnet':
-                        'magnet:?xt=urn:btih:' +
-                        base64.b16encode(base64.b64decode(row[1])).decode('utf-8') +
-                        '&dn=' +
-                        parse.quote(row[2]),
-                    }
-                results.append(result)
-        # limit page size to not print walls of results
-        # TODO: consider pagination
-        results = results[:30]
-        return results
+            if query in row[2].lower():
+                yield row
+
+# characters outside ascii that str.lower() turns into ascii letters,
+# by their utf-8 bytes. bytes.lower() leaves them alone
+folded = {
+    b'k': '\u212a'.encode('utf-8'),  # kelvin sign
+    b'i': '\u0130'.encode('utf-8'),  # capital i with dot above
+}
+
+# what to look for in the lowercased bytes: the query, and the folded
+# characters a title could match it through
+def needles(needle):
+    return [needle] + [value for key, value in folded.items()
+                       if key in needle]
+
+# the first position from start where one of needles is, or -1. found
+# keeps the next position of each of them between calls
+def find_any(data, needles, start, found):
+    for i, needle in enumerate(needles):
+        if found[i] != -1 and found[i] < start:
+            found[i] = data.find(needle, start)
+    hits = [pos for pos in found if pos != -1]
+    return min(hits) if hits else -1
+
+# search the lowercased raw bytes and only parse the lines that contain
+# the query somewhere, the title check weeds out hits in other columns
+def scan_block(block, needle, query):
+    if b'\0' in block:
+        block = block.replace(b'\0', b'')
+    lowered = block.lower()
+    patterns = needles(needle)
+    found = [-2] * len(patterns)
+    pos = find_any(lowered, patterns, 0, found)
+    while pos != -1:
+        start = block.rfind(b'\n', 0, pos) + 1
+        end = block.find(b'\n', pos)
+        if end == -1:
+            end = len(block)
+        row = parse_line(block[start:end])
+        if row is not None and query in row[2].lower():
+            yield row
+        pos = find_any(lowered, patterns, end, found)
+
+def scan_range(db, needle, query, start, end):
+    with open(db, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            while start < end:
+                stop = m.find(b'\n', start + block_size, end)
+                stop = end if stop == -1 else stop + 1
+                yield from scan_block(m[start:stop], needle, query)
+                start = stop
+
+# a compressed dump can't be mapped or seeked into, it is read in blocks
+# and the partial line at the end of each block is carried over
+def scan_stream(f, needle, query):
+    carry = b''
+    while True:
+        block = f.read(block_size)
+        if not block:
+            break
+        block = carry + block
+        cut = block.rfind(b'\n') + 1
+        carry = block[cut:]
+        yield from scan_block(block[:cut], needle, query)
+    yield from scan_block(carry, needle, query)
+
+def scan_compressed(db, needle, query):
+    with open_dump(db) as f:
+        yield from scan_stream(f, needle, query)
+
+# runs in the worker processes
+def scan_part(db, needle, query, start, end, reduce):
+    return reduce(scan_range(db, needle, query, start, end))
+
+# cut the dump in byte ranges that start at the beginning of a line
+def split(db, parts):
+    bounds = [0]
+    with open(db, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        for i in range(1, parts):
+            f.seek(size * i // parts)
+            f.readline()
+            if bounds[-1] < f.tell() < size:
+                bounds.append(f.tell())
+    bounds.append(size)
+    return list(zip(bounds, bounds[1:]))
+
+# reduce turns the matching rows into the returned list. with several
+# workers part_reduce (reduce by default) runs once per part and reduce
+# once more over the joined parts
+def scan(db, query, workers=1, reduce=list, part_reduce=None):
+    # bytes.lower() only folds ascii, other queries need the slow path
+    try:
+        needle = query.encode('ascii')
+    except UnicodeEncodeError:
+        needle = b''
+    if not needle:
+        return reduce(scan_text(db, query))
+
+    # decompression is sequential, so there's nothing to split
+    if is_compressed(db):
+        return reduce(scan_compressed(db, needle, query))
+
+    if workers == 1:
+        return reduce(scan_range(db, needle, query, 0, os.path.getsize(db)))
+
+    # more ranges than workers keeps them all busy until the end, the
+    # parts are joined in file order so the output is deterministic
+    ranges = split(db, (workers or os.cpu_count()) * 4)
+    with concurrent.futures.ProcessPoolExecutor(workers or None) as pool:
+        parts = [pool.submit(scan_part, db, needle, query, start, end,
+                             part_reduce or reduce)
+                 for start, end in ranges]
+        return reduce(itertools.chain.from_iterable(
+            part.result() for part in parts))
+
+# how rows can be sorted, keyed like pirate.data.sorts
+row_keys = {
+    'name': lambda row: row[2],
+    'raw_uploaded': lambda row: parse_date(row[0]),
+    'raw_size': lambda row: int(row[3]),
+}
+
+# the items from offset up to count in sort order. items the dump can't
+# sort by stay in file order and the ones before offset are skipped, so
+# only the page is kept in memory. sorting keeps the count first items
+def select(items, keys, sort=None, count=None, offset=0):
+    key, reverse = sort or (None, False)
+    key = keys.get(key)
+    if key is None:
+        return list(itertools.islice(items, offset, count))
+    if count is None:
+        return sorted(items, key=key, reverse=reverse)[offset:]
+    if reverse:
+        return heapq.nlargest(count, items, key=key)[offset:]
+    return heapq.nsmallest(count, items, key=key)[offset:]
+
+def in_ranges(row, size=None, date=None):
+    return within(int(row[3]), size) and within(parse_date(row[0]), date)
+
+def pick(rows, size=None, date=None, sort=None, count=None, offset=0):
+    rows = (row for row in rows if in_ranges(row, size, date))
+    return select(rows, row_keys, sort, count, offset)
+
+def search(db, terms, workers=1, size=None, date=None,
+           sort=None, limit=30, page=1, ranked=False):
+    query = ' '.join(terms).lower()
+    # pages are limit results long. unsorted pages only keep their own
+    # rows while searching, sorted ones the rows up to their end
+    offset = 0 if limit is None else (max(page, 1) - 1) * limit
+    count = None if limit is None else offset + limit
+
+    # relevance ranking needs the statistics of the word index
+    index = pirate.index.open_index(db) if ranked else None
+    if index is not None:
+        with index:
+            accept = None
+            if size is not None or date is not None:
+                accept = functools.partial(in_ranges, size=size, date=date)
+            rows = index.rank(query, count or index.meta['rows'], accept)
+            return [build_result(row) for row in rows[offset:]]
+
+    # the compiled store has every column ready to filter on, the word
+    # index narrows down the rows it looks at. both number the rows of
+    # the dump the same way, as long as they cover the same rows
+    tokens = pirate.index.tokenize(query)
+    store = pirate.store.open_store(db)
+    if store is not None:
+        with store:
+            index = pirate.index.open_index(db) if tokens else None
+            if index is not None and index.meta['rows'] != len(store):
+                index.close()
+                index = None
+            candidates = None
+            if index is not None:
+                candidates = index.candidates(tokens)
+            try:
+                rows = store.search(query, size, date, candidates)
+                rows = select(rows, store.keys(), sort, count, offset)
+            finally:
+                # a search cut short still holds views of the index
+                if index is not None:
+                    candidates.close()
+                    index.close()
+            return [store.result(i) for i in rows]
+
+    # the parts of a parallel scan can't know how many rows come before
+    # them, they keep the rows up to the end of the page
+    part_reduce = functools.partial(pick, size=size, date=date,
+                                    sort=sort, count=count)
+    reduce = functools.partial(part_reduce, offset=offset)
+
+    # answer from the inverted index when there is an up to date one,
+    # it finds the same rows as a scan
+    index = pirate.index.open_index(db) if tokens else None
+    if index is not None:
+        with index:
+            rows = reduce(index.search(query))
+    else:
+        rows = scan(db, query, workers, reduce, part_reduce)
+
+    return [build_result(row) for row in rows]
+
+# without an index every row has to be looked at, but only the hash
+# column is decoded
+def scan_hashes(db, hashes):
+    wanted = {base64.b64encode(h): h for h in hashes}
+    found = {}
+    with open_dump(db) as f:
+        for line in f:
+            fields = line.split(b';', 2)
+            if len(fields) == 3 and fields[1] in wanted:
+                row = parse_line(line)
+                if row is not None:
+                    found.setdefault(wanted[fields[1]], row)
+    return found
+
+# results for raw info hashes, in the same order, and the hashes that
+# aren't in the database
+def lookup(db, hashes):
+    index = pirate.index.open_index(db)
+    if index is not None:
+        with index:
+            rows = {h: index.find(h) for h in hashes}
+    else:
+        rows = scan_hashes(db, hashes)
+
+    results = []
+    missing = []
+    for info_hash in hashes:
+        if rows.get(info_hash) is None:
+            missing.append(info_hash)
+        else:
+            results.append(build_result(rows[info_hash]))
+    return results, missing
@@ -0,0 +1,286 @@
+import zlib
+import socket
+import threading
+import http.client
+import urllib.request as request
+import urllib.error
+
+import pirate.data
+
+
+# idle connections kept open per host
+max_idle = 8
+
+# compressed replies are read from the socket this many bytes at a time
+chunk_size = 1 << 14
+
+
+# idle persistent connections by (scheme, host, proxy tunnel). a
+# connection only comes back here once its response was read to the end
+class Pool:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connections = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            idle = self.connections.get(key)
+            if idle:
+                self.hits += 1
+                return idle.pop()
+            self.misses += 1
+            return None
+
+    def put(self, key, conn):
+        with self.lock:
+            idle = self.connections.setdefault(key, [])
+            idle.append(conn)
+            if len(idle) > max_idle:
+                idle.pop(0).close()
+
+    def close(self):
+        with self.lock:
+            for idle in self.connections.values():
+                for conn in idle:
+                    conn.close()
+            self.connections.clear()
+
+    def stats(self):
+        return 'connection pool: {} hits, {} misses'.format(
+            self.hits, self.misses)
+
+
+pool = Pool()
+
+
+# hands its connection back to the pool when it is read to the end, a
+# response closed before that leaves unread data behind and the
+# connection is closed with it
+class PooledResponse(http.client.HTTPResponse):
+    pool_key = None
+    connection = None
+    unfinished = False
+
+    def close(self):
+        if self.fp is not None:
+            self.unfinished = True
+        super().close()
+
+    # http.client calls this at the end of the body and from close()
+    def _close_conn(self):
+        super()._close_conn()
+        conn, self.connection = self.connection, None
+        if conn is None:
+            return
+        if self.unfinished:
+            conn.close()
+        else:
+            pool.put(self.pool_key, conn)
+
+
+# like urllib's own handlers, but the connection isn't closed after the
+# response so the next request to the same host can use it
+class KeepAliveMixin:
+    def pooled_open(self, http_class, req, **http_conn_args):
+        host = req.host
+        if not host:
+            raise urllib.error.URLError('no host given')
+        key = (http_class.__name__, host, req._tunnel_host)
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update({k: v for k, v in req.headers.items()
+                        if k not in headers})
+        headers['Connection'] = 'keep-alive'
+        headers = {name.title(): val for name, val in headers.items()}
+        tunnel_headers = {}
+        if 'Proxy-Authorization' in headers:
+            tunnel_headers['Proxy-Authorization'] = \
+                headers.pop('Proxy-Authorization')
+
+        conn = pool.get(key)
+        while True:
+            reused = conn is not None
+            if not reused:
+                conn = http_class(host, timeout=req.timeout,
+                                  **http_conn_args)
+                conn.set_debuglevel(self._debuglevel)
+                conn.response_class = PooledResponse
+                if req._tunnel_host:
+                    conn.set_tunnel(req._tunnel_host, headers=tunnel_headers)
+
+            try:
+                if reused:
+                    conn.timeout = req.timeout
+                    if conn.sock is not None:
+                        conn.sock.settimeout(req.timeout)
+                conn.request(req.get_method(), req.selector, req.data,
+                             headers, encode_chunked=req.has_header(
+                                 'Transfer-encoding'))
+                response = conn.getresponse()
+                break
+            except (OSError, http.client.HTTPException) as e:
+                conn.close()
+                # the server may have dropped an idle connection, that
+                # one gets a single retry on a new connection. a timeout
+                # isn't that, and socket.timeout is only a TimeoutError
+                # since python 3.10
+                if reused and not isinstance(e, (socket.timeout,
+                                                 TimeoutError)):
+                    conn = None
+                    continue
+                if isinstance(e, OSError):
+                    raise urllib.error.URLError(e)
+                raise
+            except BaseException:
+                conn.close()
+                raise
+
+        if response.will_close:
+            conn.close()
+        else:
+            response.pool_key = key
+            response.connection = conn
+            # a reply without a body is already read to the end
+            if response.length == 0:
+                response.read()
+
+        response.url = req.get_full_url()
+        response.msg = response.reason
+        return response
+
+class KeepAliveHTTPHandler(KeepAliveMixin, request.HTTPHandler):
+    def http_open(self, req):
+        return self.pooled_open(http.client.HTTPConnection, req)
+
+
+class KeepAliveHTTPSHandler(KeepAliveMixin, request.HTTPSHandler):
+    def https_open(self, req):
+        return self.pooled_open(http.client.HTTPSConnection, req,
+                                context=self._context)
+
+
+# make every urllib.request.urlopen call go through the pool
+def install():
+    request.install_opener(request.build_opener(
+        KeepAliveHTTPHandler, KeepAliveHTTPSHandler))
+
+
+# bytes read from the network and after decompression
+class Traffic:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.received = 0
+        self.decoded = 0
+
+    def add(self, received, decoded):
+        with self.lock:
+            self.received += received
+            self.decoded += decoded
+
+    def stats(self):
+        saved = 0
+        if self.decoded:
+            saved = 100 * (1 - self.received / self.decoded)
+        return 'traffic: {} bytes received, {} decoded ({:.0f}% saved)'.format(
+            self.received, self.decoded, saved)
+
+
+traffic = Traffic()
+
+
+# a reply decompressed as it is read, for the encodings fetch asks for
+class Response:
+    def __init__(self, fp, headers):
+        self.fp = fp
+        self.headers = headers
+        encoding = headers.get('Content-Encoding') if headers else None
+        self.encoding = encoding.strip().lower() \
+            if isinstance(encoding, str) else None
+        self.decoder = None
+        if self.encoding == 'gzip':
+            self.decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.pending = b''
+        self.eof = False
+
+    def info(self):
+        return self.headers
+
+    def getcode(self):
+        return self.fp.getcode()
+
+    def close(self):
+        self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def decompress(self, data):
+        if self.decoder is None:
+            # deflate is meant to be zlib wrapped, some servers send it raw
+            zlib_header = (len(data) >= 2 and data[0] & 0x0f == 8 and
+                           (data[0] << 8 | data[1]) % 31 == 0)
+            self.decoder = zlib.decompressobj(
+                zlib.MAX_WBITS if zlib_header else -zlib.MAX_WBITS)
+        try:
+            return self.decoder.decompress(data)
+        except zlib.error as e:
+            raise IOError('invalid {} reply: {}'.format(self.encoding, e))
+
+    def read(self, size=-1):
+        if self.encoding not in ('gzip', 'deflate'):
+            data = self.fp.read() if size is None or size < 0 \
+                else self.fp.read(size)
+            traffic.add(len(data), len(data))
+            return data
+
+        if size is None or size < 0:
+            data = self.fp.read()
+            decoded = self.pending + self.decompress(data) + \
+                self.decoder.flush()
+            self.pending = b''
+            self.eof = True
+            traffic.add(len(data), len(decoded))
+            return decoded
+
+        # whatever the next chunks decompress to, without waiting for
+        # more of the reply than that
+        while not self.pending and not self.eof:
+            data = self.fp.read(chunk_size)
+            if data:
+                decoded = self.decompress(data)
+            else:
+                decoded = self.decoder.flush() if self.decoder else b''
+                self.eof = True
+            traffic.add(len(data), len(decoded))
+            self.pending += decoded
+        data, self.pending = self.pending[:size], self.pending[size:]
+        return data
+
+    def readlines(self):
+        if self.encoding not in ('gzip', 'deflate'):
+            lines = self.fp.readlines()
+            size = sum(len(line) for line in lines)
+            traffic.add(size, size)
+            return lines
+        return self.read().splitlines(keepends=True)
+
+
+# every request goes through here so they all ask for compressed replies,
+# error replies are decompressed the same way
+def fetch(url, timeout, headers=None):
+    req = request.Request(url, headers=pirate.data.default_headers)
+    req.add_header('Accept-Encoding', 'gzip, deflate')
+    for name, value in (headers or {}).items():
+        req.add_header(name, value)
+    try:
+        response = request.urlopen(req, timeout=timeout)
+    except urllib.error.HTTPError as e:
+        if e.fp is not None:
+            e.fp = Response(e.fp, e.headers)
+        raise
+    return Response(response, response.info())
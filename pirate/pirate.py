@@ -1,21 +1,33 @@
 import sys
 import re
 import os
+import atexit
 import argparse
 import subprocess
 import configparser
 import socket
-import urllib.request as request
 import urllib.error
 import builtins
 import json
 import webbrowser
+import calendar
+import itertools
+import time
+import queue
+import threading
 
 import pirate.data
 import pirate.torrent
 import pirate.local
+import pirate.index
+import pirate.store
+import pirate.batch
+import pirate.net
+import pirate.cache
+import pirate.scoreboard
 
 from os.path import expanduser, expandvars
+from datetime import datetime
 from pirate.print import Printer
 
 
@@ -31,6 +43,16 @@ def parse_config_file(text):
     config.add_section('LocalDB')
     config.set('LocalDB', 'enabled', 'false')
     config.set('LocalDB', 'path', expanduser('~/downloads/pirate-get/db'))
+    config.set('LocalDB', 'workers', 1)
+
+    config.add_section('Cache')
+    config.set('Cache', 'enabled', 'true')
+    config.set('Cache', 'directory', os.path.join(
+        os.getenv('XDG_CACHE_HOME', '~/.cache'), 'pirate-get'))
+    # seconds a discovered mirror api is trusted without probing again
+    config.set('Cache', 'api-ttl', 7 * 24 * 3600)
+    # seconds before the proxy bay mirror list is downloaded again
+    config.set('Cache', 'mirror-list-ttl', 24 * 3600)
 
     config.add_section('Search')
     config.set('Search', 'total-results', 50)
@@ -52,9 +74,11 @@ def parse_config_file(text):
     # expand env variables
     directory = expanduser(expandvars(config.get('Save', 'Directory')))
     path = expanduser(expandvars(config.get('LocalDB', 'path')))
+    cache = expanduser(expandvars(config.get('Cache', 'directory')))
 
     config.set('Save', 'Directory', directory)
     config.set('LocalDB', 'path', path)
+    config.set('Cache', 'directory', cache)
 
     return config
 
@@ -86,6 +110,24 @@ def parse_cmd(cmd, url):
     return ret_no_quotes
 
 
+def parse_size(text):
+    units = {'': 1, 'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30,
+             't': 1 << 40, 'p': 1 << 50}
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([kmgtp]?)(?:i?b)?\s*',
+                         text, flags=re.IGNORECASE)
+    if not match:
+        raise argparse.ArgumentTypeError('invalid size: ' + text)
+    return int(float(match.group(1)) * units[match.group(2).lower()])
+
+
+def parse_date(text):
+    try:
+        date = datetime.strptime(text, '%Y-%m-%d')
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid date: ' + text)
+    return calendar.timegm(date.timetuple())
+
+
 def parse_torrent_command(l):
     # Very permissive handling
     # Check for any occurances of c, d, f, p, t, m, or q
@@ -134,7 +176,9 @@ def parse_args(args_in):
     parser.add_argument('-c', '--category',
                         help='specify a category to search', default='All')
     parser.add_argument('-s', '--sort',
-                        help='specify a sort option', default='SeedersDsc')
+                        help='specify a sort option, or several comma '
+                             'separated to break ties (default: SeedersDsc, '
+                             'none with --jsonl)')
     parser.add_argument('-R', '--recent',
                         action='store_true',
                         help='torrents uploaded in the last 48hours. '
@@ -152,10 +196,53 @@ def parse_args(args_in):
     parser.add_argument('-r', '--total-results',
                         type=int,
                         help='maximum number of results to show')
+    parser.add_argument('-H', '--hash',
+                        nargs='+', dest='hashes', metavar='HASH',
+                        help='look up info hashes in the local database')
+    parser.add_argument('--hash-file',
+                        metavar='FILE',
+                        help='look up the info hashes listed in a file, '
+                             'one per line')
+    parser.add_argument('--query-file',
+                        metavar='FILE',
+                        help='search the local database for every query '
+                             'listed in a file, one per line, printing '
+                             'the matches as json lines')
+    parser.add_argument('--rank',
+                        action='store_true',
+                        help='order local results by relevance, matching '
+                             'any of the words (needs --build-index)')
+    parser.add_argument('--page',
+                        default=1, type=int,
+                        help='the page of results to show, pages are '
+                             '--total-results long (only used with --local)')
     parser.add_argument('-L', '--local', dest='database',
                         help='a csv file containing the Pirate Bay database '
                              'downloaded from '
                              'https://thepiratebay.org/static/dump/csv/')
+    parser.add_argument('--build-index',
+                        action='store_true',
+                        help='build a word index of the local database '
+                             'to speed up searches')
+    parser.add_argument('--compile-db',
+                        action='store_true',
+                        help='compile the local database into a compact '
+                             'binary store to speed up searches')
+    parser.add_argument('--min-size',
+                        type=parse_size, metavar='SIZE',
+                        help='only show local results at least this big '
+                             '(ex. 700M, 1.5GiB)')
+    parser.add_argument('--max-size',
+                        type=parse_size, metavar='SIZE',
+                        help='only show local results at most this big')
+    parser.add_argument('--after',
+                        type=parse_date, metavar='YYYY-MM-DD',
+                        help='only show local results uploaded on or '
+                             'after this date')
+    parser.add_argument('--before',
+                        type=parse_date, metavar='YYYY-MM-DD',
+                        help='only show local results uploaded before '
+                             'this date')
     parser.add_argument('-0', dest='first',
                         action='store_true',
                         help='choose the top result')
@@ -191,6 +278,15 @@ def parse_args(args_in):
     parser.add_argument('-m', '--mirror',
                         type=str, nargs='+',
                         help='the pirate bay mirror(s) to use')
+    parser.add_argument('--race',
+                        nargs='?', type=float, const=1.0, metavar='DELAY',
+                        help='try the next mirror after DELAY seconds '
+                             '(default: 1) without waiting for the '
+                             'previous ones, the first to answer wins')
+    parser.add_argument('--no-cache',
+                        action='store_true',
+                        help='always ask the mirror instead of using or '
+                             'storing cached results')
     parser.add_argument('-z', '--timeout', type=int,
                         help='timeout in seconds for http requests')
     parser.add_argument('-v', '--version',
@@ -199,6 +295,13 @@ def parse_args(args_in):
     parser.add_argument('-j', '--json',
                         action='store_true',
                         help='print results in JSON format to stdout')
+    parser.add_argument('--jsonl',
+                        action='store_true',
+                        help='print each result as a line of JSON to stdout '
+                             'as soon as it is received')
+    parser.add_argument('--debug',
+                        action='store_true',
+                        help='print connection statistics when done')
     args = parser.parse_args(args_in)
 
     return args
@@ -214,6 +317,14 @@ def combine_configs(config, args):
         args.action = 'list_categories'
     elif args.list_sorts:
         args.action = 'list_sorts'
+    elif args.build_index:
+        args.action = 'build_index'
+    elif args.compile_db:
+        args.action = 'compile_db'
+    elif args.hashes or args.hash_file:
+        args.action = 'hash_lookup'
+    elif args.query_file:
+        args.action = 'batch'
     elif len(args.search) == 0:
         args.action = 'top'
     else:
@@ -222,10 +333,25 @@ def combine_configs(config, args):
     args.source = 'tpb'
     if args.database or config.getboolean('LocalDB', 'enabled'):
         args.source = 'local_tpb'
+    # info hashes are only indexed locally and batches read the whole dump
+    if args.action in ('hash_lookup', 'batch'):
+        args.source = 'local_tpb'
 
     if not args.database:
         args.database = config.get('LocalDB', 'path')
 
+    args.local_workers = int(config.get('LocalDB', 'workers'))
+
+    # [low, high) ranges for filtering local results
+    args.size_range = None
+    if args.min_size is not None or args.max_size is not None:
+        args.size_range = (
+            args.min_size,
+            None if args.max_size is None else args.max_size + 1)
+    args.date_range = None
+    if args.after is not None or args.before is not None:
+        args.date_range = (args.after, args.before)
+
     if args.disable_color or not config.getboolean('Misc', 'colors'):
         args.color = False
     else:
@@ -240,6 +366,16 @@ def combine_configs(config, args):
     if not args.timeout:
         args.timeout = int(config.get('Misc', 'timeout'))
 
+    # json lines are streamed unless sorting is asked for
+    if args.sort is None and not args.jsonl:
+        args.sort = 'SeedersDsc'
+
+    args.cache_dir = None
+    if config.getboolean('Cache', 'enabled'):
+        args.cache_dir = config.get('Cache', 'directory')
+    args.api_ttl = int(config.get('Cache', 'api-ttl'))
+    args.mirror_list_ttl = int(config.get('Cache', 'mirror-list-ttl'))
+
     config_total_results = int(config.get('Search', 'total-results'))
     if not args.total_results and config_total_results:
         args.total_results = config_total_results
@@ -279,20 +415,89 @@ def combine_configs(config, args):
     return args
 
 
-def connect_mirror(mirror, printer, args):
-    try:
-        printer.print('Trying', mirror, end='... ')
-        url = pirate.torrent.find_api(mirror, args.timeout)
-        results = pirate.torrent.remote(
+# a list of (key, reverse) pairs, sorts can be given comma separated
+def chosen_sort(printer, args):
+    if args.sort is None:
+        return None
+    return [pirate.torrent.parse_sort(printer, sort.strip())
+            for sort in str(args.sort).split(',')]
+
+
+def fetch_results(url, printer, args, cancel=None):
+    category = pirate.torrent.parse_category(printer, args.category)
+    sort = chosen_sort(printer, args)
+    cache_dir = None if args.no_cache else args.cache_dir
+    if not args.jsonl or sort is not None:
+        # only what is shown needs to be sorted
+        limit = None
+        if not args.json and not args.jsonl:
+            limit = args.total_results or None
+        return pirate.torrent.remote(
             printer=printer,
             pages=args.pages,
-            category=pirate.torrent.parse_category(printer, args.category),
-            sort=pirate.torrent.parse_sort(printer, args.sort),
+            category=category,
+            sort=sort,
             mode=args.action,
             terms=args.search,
             mirror=url,
-            timeout=args.timeout)
-    except (urllib.error.URLError, socket.timeout, IOError, ValueError) as e:
+            timeout=args.timeout,
+            cache_dir=cache_dir,
+            limit=limit,
+            cancel=cancel)
+
+    results = pirate.torrent.iter_remote(
+        args.pages, category, args.action, args.search, url,
+        args.timeout, cache_dir, cancel)
+    # the mirror works once the first result (or the end) comes
+    # through, the rest is streamed as it arrives
+    first = next(results, None)
+    if first is None:
+        return []
+    return itertools.chain([first], results)
+
+
+# what a mirror that doesn't work raises
+mirror_errors = (urllib.error.URLError, socket.timeout, IOError, ValueError)
+
+
+# keeps score of how the mirror did, unless it was cancelled
+def query_mirror(mirror, printer, args, cancel=None):
+    start = time.monotonic()
+    try:
+        results = query_api(mirror, printer, args, cancel)
+    except mirror_errors:
+        if cancel is None or not cancel.is_set():
+            pirate.scoreboard.record(args.cache_dir, mirror, False)
+        raise
+    pirate.scoreboard.record(args.cache_dir, mirror, True,
+                             time.monotonic() - start)
+    return results
+
+
+def query_api(mirror, printer, args, cancel=None):
+    # go straight to the api found last time, only when that fails
+    # the mirror is probed again
+    url = pirate.cache.get(args.cache_dir, 'api', mirror, args.api_ttl)
+    if url is not None:
+        try:
+            return fetch_results(url, printer, args, cancel)
+        # the api moved if it answers with an error or not with json, a
+        # mirror that is down wouldn't answer the probes either
+        except (urllib.error.HTTPError, ValueError):
+            # a cancelled mirror may well still have the api there
+            if cancel is not None and cancel.is_set():
+                raise
+            pirate.cache.delete(args.cache_dir, 'api', mirror)
+    url = pirate.torrent.find_api(mirror, args.timeout)
+    pirate.cache.put(args.cache_dir, 'api', mirror, url)
+    return fetch_results(url, printer, args, cancel)
+
+
+def connect_mirror(mirror, printer, args):
+    try:
+        printer.print('Trying', mirror, end='... ')
+        results = query_mirror(mirror, printer, args)
+    except mirror_errors as e:
         printer.print('Failed', color='WARN', end=' ')
         printer.print('(', e, ')', sep='')
         return None
@@ -301,18 +506,56 @@ def connect_mirror(mirror, printer, args):
         return results, mirror
 
 
-def search_mirrors(printer, args):
-    # try default or user mirrors
-    for mirror in args.mirror:
-        result = connect_mirror(mirror, printer, args)
-        if result is not None:
-            return result
+# best first by how they did before, leaving out the ones that failed
+# too often lately
+def ranked_mirrors(mirrors, printer, args):
+    ready, skipped = pirate.scoreboard.rank(
+        args.cache_dir, mirrors, args.timeout)
+    for mirror, wait in skipped:
+        printer.print('Skipping', mirror, '(failing, retrying in',
+                      '{:.0f} minutes)'.format(wait / 60 + 0.5))
+    return ready
+
+
+# the default or user mirrors, then the ones in the proxy bay list
+def candidate_mirrors(printer, args):
+    yield from ranked_mirrors(args.mirror, printer, args)
+    mirrors = [m for m in mirror_list(args)
+               if m not in pirate.data.blacklist]
+    yield from ranked_mirrors(mirrors, printer, args)
+
+
+# the proxy bay list from the cache while it is younger than the ttl.
+# an older copy is still used right away while a fresh one is downloaded
+# in the background, and when the download fails
+def mirror_list(args):
+    mirrors, age = pirate.cache.lookup(args.cache_dir, 'proxy-bay', 'list')
+    if mirrors is None:
+        mirrors = fetch_mirror_list(args)
+        pirate.cache.put(args.cache_dir, 'proxy-bay', 'list', mirrors)
+    elif age >= args.mirror_list_ttl:
+        thread = threading.Thread(target=refresh_mirror_list, args=(args,),
+                                  daemon=True)
+        thread.start()
+        # a run shorter than the download would otherwise kill it every
+        # time and the list would stay stale
+        atexit.register(thread.join, args.timeout)
+    return mirrors
+
+
+def refresh_mirror_list(args):
+    try:
+        mirrors = fetch_mirror_list(args)
+    except IOError:
+        # the copy in the cache stays in use
+        return
+    pirate.cache.put(args.cache_dir, 'proxy-bay', 'list', mirrors)
+
 
+def fetch_mirror_list(args):
     # download mirror list
     try:
-        req = request.Request(pirate.data.mirror_list,
-                              headers=pirate.data.default_headers)
-        f = request.urlopen(req, timeout=args.timeout)
+        f = pirate.net.fetch(pirate.data.mirror_list, args.timeout)
     except urllib.error.URLError as e:
         raise IOError('Could not fetch mirrors', e.reason)
 
@@ -320,12 +563,15 @@ def search_mirrors(printer, args):
         raise IOError('The proxy bay responded with an error',
                       f.read().decode('utf-8'))
 
-    mirrors = [i.decode('utf-8').strip() for i in f.readlines()][3:]
+    return [i.decode('utf-8').strip() for i in f.readlines()][3:]
+
+
+def search_mirrors(printer, args):
+    if args.race is not None:
+        return race_mirrors(printer, args)
 
     # try mirrors
-    for mirror in mirrors:
-        if mirror in pirate.data.blacklist:
-            continue
+    for mirror in candidate_mirrors(printer, args):
         result = connect_mirror(mirror, printer, args)
         if result is not None:
             return result
@@ -333,6 +579,104 @@ def search_mirrors(printer, args):
         raise IOError('No more available mirrors')
 
 
+# start on the next mirror every args.race seconds until one answers,
+# or right away when one fails. the first answer wins and cancels the
+# others, they stop before their next page. a request they are waiting
+# for is left to its daemon thread
+def race_mirrors(printer, args):
+    def run(mirror, cancel):
+        try:
+            results = query_mirror(mirror, printer, args, cancel)
+            answers.put((mirror, results, None))
+        except BaseException as e:
+            # anything else is raised by the race, it must not hang
+            answers.put((mirror, None, e))
+
+    # only the losers are cancelled, the winner's results may still be
+    # streaming
+    def cancel_others(winner=None):
+        for mirror, cancel in cancels.items():
+            if mirror != winner:
+                cancel.set()
+
+    answers = queue.Queue()
+    cancels = {}
+    mirrors = candidate_mirrors(printer, args)
+    error = IOError('No more available mirrors')
+    running = 0
+    while True:
+        mirror = None
+        if mirrors is not None:
+            try:
+                mirror = next(mirrors)
+            except StopIteration:
+                mirrors = None
+            except IOError as e:
+                # the mirrors already running may still answer
+                error = e
+                mirrors = None
+        if mirror is not None:
+            printer.print('Trying', mirror)
+            cancels[mirror] = threading.Event()
+            threading.Thread(target=run, args=(mirror, cancels[mirror]),
+                             daemon=True).start()
+            running += 1
+        elif running == 0:
+            raise error
+
+        try:
+            winner, results, e = answers.get(
+                timeout=None if mirrors is None else args.race)
+        except queue.Empty:
+            continue
+        running -= 1
+        if e is None:
+            cancel_others(winner)
+            printer.print('Using', winner, color='alt')
+            return results, winner
+        if not isinstance(e, mirror_errors):
+            cancel_others()
+            raise e
+        printer.print(winner, 'failed', color='WARN', end=' ')
+        printer.print('(', e, ')', sep='')
+
+
+def lookup_hashes(printer, args):
+    texts = list(args.hashes or [])
+    if args.hash_file:
+        with open(args.hash_file) as f:
+            texts.extend(line for line in f
+                         if line.strip() and not line.startswith('#'))
+
+    hashes = []
+    for text in texts:
+        try:
+            hashes.append(pirate.local.parse_hash(text))
+        except ValueError as e:
+            printer.print(e, color='WARN')
+
+    results, missing = pirate.local.lookup(args.database, hashes)
+    for info_hash in missing:
+        printer.print('Not found: {}'.format(info_hash.hex().upper()),
+                      color='WARN')
+    return results
+
+
+def print_jsonl(printer, results):
+    try:
+        for result in results:
+            print(json.dumps(result,
+                             default=pirate.torrent.TorrentResult.as_dict),
+                  flush=True)
+    except KeyboardInterrupt:
+        printer.print('\nCancelled.')
+        sys.exit(0)
+    except mirror_errors as e:
+        printer.print('Failed', color='WARN', end=' ')
+        printer.print('(', e, ')', sep='')
+        sys.exit(1)
+
+
 def pirate_main(args):
     printer = Printer(args.color)
 
@@ -373,15 +717,60 @@ def pirate_main(args):
             printer.print(str(value[0]), '\t', key, sep='', color=cur_color)
         return
 
+    # everything else reads the local dump
+    if (args.action in ('build_index', 'compile_db') or
+            args.source == 'local_tpb'):
+        if not os.path.isfile(args.database):
+            printer.print("Local pirate bay database doesn't exist.",
+                          '(%s)' % args.database, color='ERROR')
+            sys.exit(1)
+
+    if args.action in ('build_index', 'compile_db'):
+        # the index and the store point at byte offsets in the dump
+        if pirate.local.is_compressed(args.database):
+            printer.print('Indexing and compiling need an uncompressed '
+                          'database.', '(%s)' % args.database, color='ERROR')
+            sys.exit(1)
+        if args.action == 'build_index':
+            printer.print('Indexing', args.database, end='... ')
+            rows = pirate.index.build(args.database)
+            path = pirate.index.index_path(args.database)
+        else:
+            printer.print('Compiling', args.database, end='... ')
+            rows = pirate.store.build(args.database)
+            path = pirate.store.store_path(args.database)
+        printer.print('Ok', color='alt')
+        printer.print('Processed {} torrents into {}'.format(rows, path))
+        return
+
+    if args.action == 'batch':
+        with open(args.query_file) as f:
+            queries = [line.strip() for line in f
+                       if line.strip() and not line.startswith('#')]
+        for query, result in pirate.batch.search(args.database, queries):
+            print(json.dumps(dict(query=query, **result)))
+        return
+
     # fetch torrents
 
     if args.source == 'local_tpb':
-        if os.path.isfile(args.database):
-            results = pirate.local.search(args.database, args.search)
+        if args.action == 'hash_lookup':
+            results = lookup_hashes(printer, args)
         else:
-            printer.print("Local pirate bay database doesn't exist.",
-                          '(%s)' % args.database, color='ERROR')
-            sys.exit(1)
+            if (args.rank and
+                    pirate.index.current_meta(args.database) is None):
+                printer.print('Ranking needs an up to date index, run '
+                              'pirate-get --build-index', color='WARN')
+            results = pirate.local.search(
+                args.database, args.search,
+                workers=args.local_workers,
+                size=args.size_range,
+                date=args.date_range,
+                # the local database sorts by one key
+                sort=(chosen_sort(printer, args) or [None])[0],
+                limit=args.total_results,
+                page=args.page,
+                ranked=args.rank)
     elif args.source == 'tpb':
         try:
             results, site = search_mirrors(printer, args)
@@ -391,12 +780,17 @@ def pirate_main(args):
                 printer.print(e.args[1])
             sys.exit(1)
 
+    if args.jsonl:
+        print_jsonl(printer, results)
+        return
+
     if len(results) == 0:
         printer.print('No results')
         return
 
     if args.json:
-        print(json.dumps(results))
+        print(json.dumps(results,
+                         default=pirate.torrent.TorrentResult.as_dict))
         return
     else:
         # Results are sorted on the request, so it's safe to remove results here.
@@ -442,7 +836,8 @@ def pirate_main(args):
                 elif code == 'd':
                     printer.descriptions(choices, results, site, args.timeout)
                 elif code == 'f':
-                    printer.file_lists(choices, results, site, args.timeout)
+                    printer.file_lists(choices, results, site, args.timeout,
+                                       args.save_directory, args.cache_dir)
                 elif code == 'p':
                     printer.search_results(results)
                 elif code == 'm':
@@ -453,7 +848,8 @@ def pirate_main(args):
                 elif code == 't':
                     pirate.torrent.save_torrents(printer, choices, results,
                                                  args.save_directory,
-                                                 args.timeout)
+                                                 args.timeout,
+                                                 args.cache_dir)
                 elif not cmd:
                     printer.print('No links entered!', color='WARN')
                 else:
@@ -474,7 +870,8 @@ def pirate_main(args):
         printer.print('Saving selected torrents...')
         pirate.torrent.save_torrents(printer, choices,
                                      results, args.save_directory,
-                                     args.timeout)
+                                     args.timeout,
+                                     args.cache_dir)
         return
 
     for choice in choices:
@@ -495,7 +892,15 @@ def pirate_main(args):
 
 def main():
     args = combine_configs(load_config(), parse_args(sys.argv[1:]))
-    pirate_main(args)
+    # all the http requests share one pool of keep-alive connections
+    pirate.net.install()
+    try:
+        pirate_main(args)
+    finally:
+        if args.debug:
+            printer = Printer(args.color)
+            printer.print(pirate.net.pool.stats())
+            printer.print(pirate.net.traffic.stats())
 
 
 if __name__ == '__main__':
@@ -1,19 +1,17 @@
 import builtins
 import re
-import gzip
-import urllib.request as request
 import shutil
 import json
 import sys
 
 import pirate.data
 import pirate.torrent
+import pirate.net
+import pirate.bencode
 
 import colorama
 import veryprettytable as pretty
 
-from io import BytesIO
-
 
 class Printer:
     def __init__(self, enable_color):
@@ -99,14 +97,8 @@ class Printer:
     def descriptions(self, chosen_links, results, site, timeout):
         for link in chosen_links:
             result = results[link]
-            req = request.Request(
-                site + '/t.php?id=' + str(result['id']),
-                headers=pirate.data.default_headers)
-            req.add_header('Accept-encoding', 'gzip')
-            f = request.urlopen(req, timeout=timeout)
-
-            if f.info().get('Content-Encoding') == 'gzip':
-                f = gzip.GzipFile(fileobj=BytesIO(f.read()))
+            f = pirate.net.fetch(
+                site + '/t.php?id=' + str(result['id']), timeout)
 
             res = json.load(f)
 
@@ -118,7 +110,8 @@ class Printer:
                        color='zebra_1')
             self.print(desc, color='zebra_0')
 
-    def file_lists(self, chosen_links, results, site, timeout):
+    def file_lists(self, chosen_links, results, site, timeout,
+                   folder=None, cache_dir=None):
         # the API may returns object instead of list
         def get(obj):
             try:
@@ -128,27 +121,41 @@ class Printer:
 
         for link in chosen_links:
             result = results[link]
-            req = request.Request(
-                site + '/f.php?id=' + str(result['id']),
-                headers=pirate.data.default_headers)
-            req.add_header('Accept-encoding', 'gzip')
-            f = request.urlopen(req, timeout=timeout)
-
-            if f.info().get('Content-Encoding') == 'gzip':
-                f = gzip.GzipFile(fileobj=BytesIO(f.read()))
-
-            res = json.load(f)
 
-            if len(res) == 1 and 'not found' in get(res[0]['name']):
-                self.print('File list not available.')
-                return
+            # a saved .torrent has the list, if it is the right one
+            files = None
+            saved = pirate.torrent.saved_torrent(result, folder, cache_dir)
+            if saved is not None:
+                with saved:
+                    try:
+                        info = pirate.bencode.read_info(saved)
+                    except ValueError:
+                        info = None
+                if info is not None and \
+                        info['info_hash'] == result['info_hash']:
+                    files = info['files']
+                else:
+                    self.print('The saved torrent does not match {:X}, '
+                               'asking the mirror'.format(result['info_hash']),
+                               color='WARN')
+
+            if files is None:
+                f = pirate.net.fetch(
+                    site + '/f.php?id=' + str(result['id']), timeout)
+
+                res = json.load(f)
+
+                if len(res) == 1 and 'not found' in get(res[0]['name']):
+                    self.print('File list not available.')
+                    return
+
+                files = [(get(f['name']), int(get(f['size']))) for f in res]
 
             self.print('Files in {}:'.format(result['name']), color='zebra_1')
             cur_color = 'zebra_0'
 
-            for f in res:
-                name = get(f['name'])
-                size = pirate.torrent.pretty_size(int(get(f['size'])))
+            for name, size in files:
+                size = pirate.torrent.pretty_size(size)
                 self.print('{:>11} {}'.format(
                     size, name),
                     color=cur_color)
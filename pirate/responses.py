@@ -0,0 +1,135 @@
+import os
+import time
+import hashlib
+import tempfile
+import threading
+
+import pirate.cache
+
+
+# seconds a reply is used without asking the mirror again, searches
+# change faster than the precompiled top 100 lists
+ttls = {
+    'search': 5 * 60,
+    'browse': 5 * 60,
+    'top': 60 * 60,
+    'recent': 60 * 60,
+}
+
+# the least recently used replies are dropped past this many bytes
+max_size = 16 << 20
+
+# pages are fetched from several threads
+lock = threading.Lock()
+
+
+# replies are kept in the responses directory of the cache, one file
+# per url named after its hash. responses.json has, by url:
+#   file           the name of that file
+#   size           its size
+#   etag, modified the validators the mirror sent with it
+#   time           when the mirror last confirmed it
+#   used           when it was last read, for the lru eviction
+def body_path(directory, entry):
+    return os.path.join(directory, 'responses', entry['file'])
+
+
+# the cached reply for url as (entry, body), or (None, None)
+def get(directory, url):
+    if directory is None:
+        return None, None
+    with lock:
+        entry = pirate.cache.load(directory, 'responses').get(url)
+        if entry is None:
+            return None, None
+        try:
+            with open(body_path(directory, entry), 'rb') as f:
+                return entry, f.read()
+        except OSError:
+            return None, None
+
+
+def fresh(entry, mode):
+    return time.time() - entry['time'] < ttls.get(mode, 0)
+
+
+def request_headers(entry):
+    headers = {}
+    if entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    if entry.get('modified'):
+        headers['If-Modified-Since'] = entry['modified']
+    return headers
+
+
+# mark a reply as read, and as confirmed by the mirror if revalidated
+def touch(directory, url, revalidated=False):
+    if directory is None:
+        return
+    with lock:
+        index = pirate.cache.load(directory, 'responses')
+        if url in index:
+            index[url]['used'] = time.time()
+            if revalidated:
+                index[url]['time'] = time.time()
+            pirate.cache.save(directory, 'responses', index)
+
+
+# a temporary file in the responses directory to write a reply into
+# while it is read, or None if there is nowhere to write it
+def spool(directory):
+    if directory is None:
+        return None
+    try:
+        os.makedirs(os.path.join(directory, 'responses'), exist_ok=True)
+        return tempfile.NamedTemporaryFile(
+            'wb', dir=os.path.join(directory, 'responses'), suffix='.tmp',
+            delete=False)
+    except OSError:
+        return None
+
+
+# remove a spooled reply that wasn't stored
+def discard(f):
+    f.close()
+    try:
+        os.remove(f.name)
+    except OSError:
+        pass
+
+
+# move a spooled reply in place as the cached one for url
+def commit(directory, url, f, etag=None, modified=None):
+    f.close()
+    with lock:
+        index = pirate.cache.load(directory, 'responses')
+        entry = {
+            'file': hashlib.sha1(url.encode('utf-8')).hexdigest(),
+            'etag': etag,
+            'modified': modified,
+            'time': time.time(),
+            'used': time.time(),
+        }
+        try:
+            entry['size'] = os.path.getsize(f.name)
+            os.chmod(f.name, 0o644)
+            os.replace(f.name, body_path(directory, entry))
+        except OSError:
+            discard(f)
+            return
+        index[url] = entry
+        evict(directory, index)
+        pirate.cache.save(directory, 'responses', index)
+
+
+def evict(directory, index):
+    total = sum(entry['size'] for entry in index.values())
+    for url in sorted(index, key=lambda url: index[url]['used']):
+        if total <= max_size:
+            break
+        entry = index.pop(url)
+        total -= entry['size']
+        try:
+            os.remove(body_path(directory, entry))
+        except OSError:
+            pass
@@ -0,0 +1,81 @@
+import time
+import threading
+
+import pirate.cache
+
+
+# how much the latest reply time weighs in the latency average
+alpha = 0.3
+
+# failures in a row after which a mirror is skipped for a while
+max_failures = 3
+
+# seconds a failing mirror is skipped, doubled every time it fails again
+# once that time is up
+cooldown = 10 * 60
+max_cooldown = 24 * 3600
+
+# racing mirrors report from several threads
+lock = threading.Lock()
+
+
+# the scoreboard is kept in mirrors.json in the cache directory:
+#   successes, failures  replies and failures so far
+#   latency              moving average of the reply time in seconds
+#   streak               failures since the last reply
+#   retry                when a skipped mirror may be tried again
+#   cooldown             how long it is skipped after the next failure
+def new_entry():
+    return {'successes': 0, 'failures': 0, 'latency': None,
+            'streak': 0, 'retry': 0, 'cooldown': cooldown}
+
+
+def record(directory, mirror, ok, latency=None):
+    with lock:
+        board = pirate.cache.load(directory, 'mirrors')
+        entry = board.setdefault(mirror, new_entry())
+        if ok:
+            entry['successes'] += 1
+            if entry['latency'] is None:
+                entry['latency'] = latency
+            else:
+                entry['latency'] += alpha * (latency - entry['latency'])
+            entry.update(streak=0, retry=0, cooldown=cooldown)
+        else:
+            entry['failures'] += 1
+            entry['streak'] += 1
+            # a failed retry after the mirror was skipped skips it again
+            # right away, for longer
+            if entry['streak'] >= max_failures:
+                entry['retry'] = time.time() + entry['cooldown']
+                entry['cooldown'] = min(entry['cooldown'] * 2, max_cooldown)
+        pirate.cache.save(directory, 'mirrors', board)
+
+
+# expected seconds spent on a mirror: its reply time when it works and
+# the whole timeout when it doesn't. unknown mirrors count as working
+# half the time in half the timeout
+def cost(entry, timeout):
+    rate = (entry['successes'] + 1) / (
+        entry['successes'] + entry['failures'] + 2)
+    latency = entry['latency']
+    if latency is None:
+        latency = timeout / 2
+    return rate * latency + (1 - rate) * timeout
+
+
+# the mirrors that aren't skipped, cheapest first, and the skipped ones
+def rank(directory, mirrors, timeout):
+    with lock:
+        board = pirate.cache.load(directory, 'mirrors')
+    now = time.time()
+    ready = []
+    skipped = []
+    for mirror in mirrors:
+        entry = board.get(mirror, new_entry())
+        if entry['retry'] > now:
+            skipped.append((mirror, entry['retry'] - now))
+        else:
+            ready.append((cost(entry, timeout), mirror))
+    ready.sort(key=lambda item: item[0])
+    return [mirror for _, mirror in ready], skipped
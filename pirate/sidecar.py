@@ -0,0 +1,107 @@
+# helpers for the files built from the database and kept next to it
+import os
+import json
+import mmap
+import hashlib
+
+
+# how much of the dump before the processed offset is checksummed to
+# notice when something other than an append changed it
+checksum_size = 1 << 16
+
+
+def read_meta(path):
+    try:
+        with open(os.path.join(path, 'meta.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_meta(path, meta):
+    tmp = os.path.join(path, 'meta.json.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp, os.path.join(path, 'meta.json'))
+
+
+# whether something built from the database still matches it
+def is_fresh(meta, db):
+    stat = os.stat(db)
+    return (meta.get('size') == stat.st_size and
+            meta.get('mtime') == stat.st_mtime)
+
+
+def tail_checksum(f, offset):
+    start = max(offset - checksum_size, 0)
+    f.seek(start)
+    return hashlib.sha1(f.read(offset - start)).hexdigest()
+
+
+# what is recorded about the dump when offset bytes of it were processed
+def dump_state(f, offset):
+    stat = os.fstat(f.fileno())
+    return {'offset': offset,
+            'checksum': tail_checksum(f, offset),
+            'size': stat.st_size,
+            'mtime': stat.st_mtime}
+
+
+# the offset where building can pick up again, the dump only grows by
+# appending so if the processed part is unchanged only the tail is new.
+# 0 means everything has to be rebuilt
+def resume_offset(meta, f, version):
+    if meta is None or meta.get('version') != version:
+        return 0
+    offset = meta['offset']
+    if os.fstat(f.fileno()).st_size < offset:
+        return 0
+    if tail_checksum(f, offset) != meta['checksum']:
+        return 0
+    return offset
+
+
+# (offset, line) of the complete lines from offset on, a line that isn't
+# finished yet is left for the next build. end[0] is kept at the end
+# offset of the last line read
+def read_lines(f, offset, end):
+    f.seek(offset)
+    for line in f:
+        if not line.endswith(b'\n'):
+            break
+        yield offset, line
+        offset += len(line)
+        end[0] = offset
+
+
+# read only memory maps of the files in a directory
+class Mapped:
+    def __init__(self, path):
+        self.path = path
+        self.maps = []
+        self.views = []
+
+    def map(self, name, fmt):
+        with open(os.path.join(self.path, name), 'rb') as f:
+            # mmap refuses empty files
+            if os.fstat(f.fileno()).st_size == 0:
+                return memoryview(b'').cast(fmt)
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.maps.append(m)
+        view = memoryview(m).cast(fmt)
+        self.views.append(view)
+        return view
+
+    def close(self):
+        for view in self.views:
+            view.release()
+        for m in self.maps:
+            m.close()
+        self.views = []
+        self.maps = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
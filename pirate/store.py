@@ -0,0 +1,233 @@
+import os
+import time
+import array
+import base64
+import bisect
+import shutil
+import urllib.parse as parse
+
+import pirate.local
+import pirate.sidecar
+
+# numpy is optional, it makes the range filters vectorized
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+version = 2
+
+# rows are buffered and appended to the columns in batches this big
+batch_size = 1 << 16
+
+
+def store_path(db):
+    return db + '.columns'
+
+
+def format_date(ts):
+    return time.strftime('%Y-%b-%d %H:%M:%S', time.gmtime(ts))
+
+
+# the store is a directory next to the database with one file per column:
+#   hashes.bin  raw 20 byte info hashes
+#   sizes.bin   sizes in bytes (int64)
+#   dates.bin   upload dates as unix timestamps (int64)
+#   titles.bin  newline terminated utf-8 titles
+#   titles.idx  offset of every title in titles.bin, plus the end (uint64)
+#   meta.json   what the store was compiled from
+# every column only grows, so rows appended to the dump are appended
+# to the columns of an existing store
+def build(db):
+    path = store_path(db)
+    meta = pirate.sidecar.read_meta(path)
+    with open(db, 'rb') as f:
+        start = pirate.sidecar.resume_offset(meta, f, version)
+        if start:
+            return add_rows(path, meta, f, start)
+
+        tmp = path + '.tmp'
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        for name in ['hashes.bin', 'sizes.bin', 'dates.bin', 'titles.bin']:
+            with open(os.path.join(tmp, name), 'wb'):
+                pass
+        with open(os.path.join(tmp, 'titles.idx'), 'wb') as offsets:
+            array.array('Q', [0]).tofile(offsets)
+        rows = add_rows(tmp, {'version': version, 'rows': 0}, f, 0)
+
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(tmp, path)
+    return rows
+
+
+def add_rows(path, meta, f, offset):
+    def column(name, size):
+        out = open(os.path.join(path, name), 'r+b')
+        # a build that died half way may have left rows past the
+        # recorded ones behind
+        out.truncate(size)
+        out.seek(size)
+        return out
+
+    count = meta['rows']
+    with open(os.path.join(path, 'titles.idx'), 'rb') as offsets:
+        offsets.seek(count * 8)
+        title_end = array.array('Q', offsets.read(8))[0]
+
+    rows = 0
+    end = [offset]
+    with column('hashes.bin', count * 20) as hashes, \
+            column('sizes.bin', count * 8) as sizes, \
+            column('dates.bin', count * 8) as dates, \
+            column('titles.bin', title_end) as titles, \
+            column('titles.idx', (count + 1) * 8) as offsets:
+        batch = {'hashes': bytearray(),
+                 'sizes': array.array('q'),
+                 'dates': array.array('q'),
+                 'titles': bytearray(),
+                 'offsets': array.array('Q')}
+
+        def flush():
+            hashes.write(batch['hashes'])
+            batch['sizes'].tofile(sizes)
+            batch['dates'].tofile(dates)
+            titles.write(batch['titles'])
+            batch['offsets'].tofile(offsets)
+            for value in batch.values():
+                del value[:]
+
+        for _, line in pirate.sidecar.read_lines(f, offset, end):
+            row = pirate.local.parse_line(line)
+            if row is None:
+                continue
+            title = row[2].encode('utf-8') + b'\n'
+            title_end += len(title)
+            batch['hashes'] += base64.b64decode(row[1]).ljust(20, b'\0')[:20]
+            batch['sizes'].append(int(row[3]))
+            batch['dates'].append(pirate.local.parse_date(row[0]))
+            batch['titles'] += title
+            batch['offsets'].append(title_end)
+            rows += 1
+            if len(batch['sizes']) >= batch_size:
+                flush()
+        flush()
+
+    meta['rows'] = count + rows
+    meta.update(pirate.sidecar.dump_state(f, end[0]))
+    pirate.sidecar.write_meta(path, meta)
+    return rows
+
+
+def open_store(db):
+    path = store_path(db)
+    meta = pirate.sidecar.read_meta(path)
+    if meta is None or meta.get('version') != version:
+        return None
+    if not pirate.sidecar.is_fresh(meta, db):
+        return None
+    return Store(path)
+
+
+class Store(pirate.sidecar.Mapped):
+    def __init__(self, path):
+        super().__init__(path)
+        self.hashes = self.map('hashes.bin', 'B')
+        self.sizes = self.map('sizes.bin', 'q')
+        self.dates = self.map('dates.bin', 'q')
+        self.titles = self.map('titles.bin', 'B')
+        self.offsets = self.map('titles.idx', 'Q')
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def title(self, i):
+        start, end = self.offsets[i], self.offsets[i + 1] - 1
+        return self.titles[start:end].tobytes().decode('utf-8')
+
+    def result(self, i):
+        title = self.title(i)
+        return {
+            'name': title,
+            'date': format_date(self.dates[i]),
+            'size': pirate.local.sizeof_fmt(self.sizes[i]),
+            'magnet':
+                'magnet:?xt=urn:btih:' +
+                base64.b16encode(self.hashes[20*i:20*i + 20]).decode() +
+                '&dn=' +
+                parse.quote(title),
+            }
+
+    # rows whose title contains the query, in file order. candidates
+    # are the rows the word index found, only their titles are checked
+    def match(self, query, candidates=None):
+        if candidates is not None:
+            for i in candidates:
+                if query in self.title(i).lower():
+                    yield i
+            return
+
+        try:
+            needle = query.encode('ascii')
+        except UnicodeEncodeError:
+            needle = b''
+        if not needle:
+            for i in range(len(self)):
+                if query in self.title(i).lower():
+                    yield i
+            return
+
+        # same block search as the csv scan, titles are newline
+        # separated so a hit can't span two of them
+        start = 0
+        blob = self.titles.obj
+        patterns = pirate.local.needles(needle)
+        while start < len(blob):
+            end = blob.find(b'\n', start + pirate.local.block_size)
+            end = len(blob) if end == -1 else end + 1
+            lowered = self.titles[start:end].tobytes().lower()
+            found = [-2] * len(patterns)
+            pos = pirate.local.find_any(lowered, patterns, 0, found)
+            while pos != -1:
+                i = bisect.bisect_right(self.offsets, start + pos) - 1
+                if query in self.title(i).lower():
+                    yield i
+                pos = pirate.local.find_any(
+                    lowered, patterns, self.offsets[i + 1] - start, found)
+            start = end
+
+    # how rows can be sorted, keyed like pirate.data.sorts
+    def keys(self):
+        return {'name': self.title,
+                'raw_uploaded': self.dates.__getitem__,
+                'raw_size': self.sizes.__getitem__}
+
+    def column(self, name):
+        return numpy.frombuffer(getattr(self, name), dtype=numpy.int64)
+
+    # keep the rows with size and date in the [low, high) ranges
+    def filter(self, rows, size=None, date=None):
+        if size is None and date is None:
+            return rows
+
+        if numpy is None:
+            return [i for i in rows
+                    if pirate.local.within(self.sizes[i], size) and
+                    pirate.local.within(self.dates[i], date)]
+
+        mask = numpy.ones(len(self), dtype=bool)
+        for name, bounds in [('sizes', size), ('dates', date)]:
+            if bounds is None:
+                continue
+            low, high = bounds
+            values = self.column(name)
+            if low is not None:
+                mask &= values >= low
+            if high is not None:
+                mask &= values < high
+        rows = numpy.fromiter(rows, dtype=numpy.int64)
+        return rows[mask[rows]].tolist()
+
+    def search(self, query, size=None, date=None, candidates=None):
+        return self.filter(self.match(query, candidates), size, date)
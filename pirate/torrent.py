@@ -1,13 +1,25 @@
 import re
 import sys
-import gzip
+import codecs
 import pyperclip
-import urllib.request as request
 import urllib.parse as parse
 import urllib.error
 import os.path
+import time
+import random
+import shutil
+import tempfile
+import concurrent.futures
+import threading
+import collections
+import heapq
+import itertools
+import operator
 
 import pirate.data
+import pirate.responses
+import pirate.net
+import pirate.torrents
 import json
 
 from datetime import datetime
@@ -41,34 +53,219 @@ def parse_sort(printer, sort):
         return pirate.data.sorts['Default'][1:]
 
 
+# replies are read and parsed this many bytes at a time
+chunk_size = 1 << 14
+
+
+# the values of the json array in f, as soon as each one is read. f can
+# be a binary or a text file
+def iter_json_array(f):
+    def invalid():
+        return IOError('invalid JSON in API reply: blocked mirror?')
+
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    buf = ''
+    pos = 0
+    eof = False
+    # what comes next: '[' to open the array, 'first' value or ']',
+    # ',' or ']' after a value, and a 'value' after a comma
+    expect = '['
+    while True:
+        while pos < len(buf) and buf[pos].isspace():
+            pos += 1
+        need_more = pos == len(buf)
+
+        if not need_more and expect == '[':
+            if buf[pos] != '[':
+                raise invalid()
+            pos += 1
+            expect = 'first'
+        elif not need_more and expect in ('first', ',') and buf[pos] == ']':
+            # stop here, there might be nothing after the array but the
+            # connection staying open
+            return
+        elif not need_more and expect == ',':
+            if buf[pos] != ',':
+                raise invalid()
+            pos += 1
+            expect = 'value'
+        elif not need_more:
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                if eof:
+                    raise invalid()
+                need_more = True
+            else:
+                # a number may go on in the next chunk, a value is only
+                # complete once what follows it has been read
+                if eof or (end < len(buf) and buf[end] in ' \t\r\n,]'):
+                    pos = end
+                    expect = ','
+                    yield value
+                else:
+                    need_more = True
+
+        if need_more:
+            if eof:
+                raise invalid()
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            if isinstance(chunk, bytes):
+                try:
+                    chunk = utf8.decode(chunk, final=eof)
+                except UnicodeDecodeError:
+                    raise invalid()
+            buf = buf[pos:] + chunk
+            pos = 0
+
+
+# a result from the api with its fields typed. the fields that are only
+# shown are computed the first time they are used, and results can be
+# indexed like the json dicts they come from
+class TorrentResult:
+    __slots__ = ('id', 'name', 'info_hash', 'leechers', 'seeders',
+                 'num_files', 'raw_size', 'username', 'raw_uploaded',
+                 'status', 'category', 'imdb', 'extra',
+                 '_size', '_uploaded', '_magnet')
+
+    # the fields in the order of the api, then the computed ones
+    keys = ('id', 'name', 'info_hash', 'leechers', 'seeders', 'num_files',
+            'size', 'username', 'added', 'status', 'category', 'imdb',
+            'raw_size', 'magnet', 'raw_uploaded', 'uploaded')
+
+    def __init__(self, res):
+        res = dict(res)
+        self.id = res.pop('id', None)
+        self.name = res.pop('name')
+        self.info_hash = int(res.pop('info_hash'), 16)
+        self.leechers = int(res.pop('leechers'))
+        self.seeders = int(res.pop('seeders'))
+        self.num_files = res.pop('num_files', None)
+        self.raw_size = int(res.pop('size'))
+        self.username = res.pop('username', None)
+        self.raw_uploaded = int(res.pop('added'))
+        self.status = res.pop('status', None)
+        self.category = int(res.pop('category'))
+        self.imdb = res.pop('imdb', None)
+        # whatever else the api sent
+        self.extra = res
+        self._size = self._uploaded = self._magnet = None
+
+    @property
+    def size(self):
+        if self._size is None:
+            self._size = pretty_size(self.raw_size)
+        return self._size
+
+    @property
+    def uploaded(self):
+        if self._uploaded is None:
+            self._uploaded = pretty_date(self.raw_uploaded)
+        return self._uploaded
+
+    @property
+    def magnet(self):
+        if self._magnet is None:
+            self._magnet = build_magnet(
+                self.name, '{:040X}'.format(self.info_hash))
+        return self._magnet
+
+    @property
+    def added(self):
+        return str(self.raw_uploaded)
+
+    def __getitem__(self, key):
+        if key in self.keys:
+            return getattr(self, key)
+        return self.extra[key]
+
+    def __repr__(self):
+        return 'TorrentResult({!r})'.format(self.as_dict())
+
+    # the result as its --json output
+    def as_dict(self):
+        res = {key: getattr(self, key) for key in self.keys[:12]}
+        res.update(self.extra)
+        for key in self.keys[12:]:
+            res[key] = getattr(self, key)
+        return res
+
+
+# the results of a page as they are read
+def iter_page(page):
+    rows = iter_json_array(page)
+
+    # a lone row saying there are no results stands for none
+    first = next(rows, None)
+    second = next(rows, None)
+    if first is None:
+        return
+    if second is None and 'No results' in first['name']:
+        return
+
+    yield TorrentResult(first)
+    if second is not None:
+        yield TorrentResult(second)
+    for res in rows:
+        yield TorrentResult(res)
+
+
 def parse_page(page):
-    results = []
-    try:
-        data = json.load(page)
-    except json.decoder.JSONDecodeError:
-        raise IOError('invalid JSON in API reply: blocked mirror?')
+    return list(iter_page(page))
+
+
+# sorts by the later keys where the earlier ones tie
+class Descending:
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
 
-    if len(data) == 1 and 'No results' in data[0]['name']:
-        return results
+# sort is a (key, reverse) pair or a list of them. the key function sorts
+# ascending, and keeps equal results in the order they came in like
+# sorted() does
+def sort_key(sort):
+    sorts = [sort] if isinstance(sort[0], str) else list(sort)
+    if len(sorts) == 1:
+        key, reverse = sorts[0]
+        if not reverse:
+            return operator.itemgetter(key)
+        return lambda res: Descending(res[key])
+    return lambda res: tuple(Descending(res[key]) if reverse else res[key]
+                             for key, reverse in sorts)
 
-    for res in data:
-        res['raw_size'] = int(res['size'])
-        res['size'] = pretty_size(int(res['size']))
-        res['magnet'] = build_magnet(res['name'], res['info_hash'])
-        res['info_hash'] = int(res['info_hash'], 16)
-        res['raw_uploaded'] = int(res['added'])
-        res['uploaded'] = pretty_date(res['added'])
-        res['seeders'] = int(res['seeders'])
-        res['leechers'] = int(res['leechers'])
-        res['category'] = int(res['category'])
-        results.append(res)
 
-    return results
+# the first limit results in sort order, without sorting the rest
+def sort_results(sort, res, limit=None):
+    if sort is None:
+        return list(itertools.islice(res, limit))
+    key = sort_key(sort)
+    if limit is None:
+        return sorted(res, key=key)
+    return heapq.nsmallest(limit, res, key=key)
 
 
-def sort_results(sort, res):
-    key, reverse = sort
-    return sorted(res, key=lambda x: x[key], reverse=reverse)
+def in_order(key, page):
+    return all(not key(b) < key(a) for a, b in zip(page, page[1:]))
+
+
+# pages the mirror already sorted only need to be merged
+def merge_pages(sort, pages, limit=None):
+    if sort is not None and len(pages) > 1:
+        key = sort_key(sort)
+        if all(in_order(key, page) for page in pages):
+            return list(itertools.islice(
+                heapq.merge(*pages, key=key), limit))
+    return sort_results(sort, itertools.chain.from_iterable(pages), limit)
 
 
 def pretty_size(size):
@@ -111,39 +308,151 @@ def build_request_path(mode, page, category, terms):
     return parse.quote(query, '?=&/')
 
 
-def remote(printer, pages, category, sort, mode, terms, mirror, timeout):
-    results = []
-    for i in range(1, pages + 1):
-        query = build_request_path(mode, i, category, terms)
+# pages are fetched concurrently by at most this many threads
+fetch_workers = 4
 
-        # Catch the Ctrl-C exception and exit cleanly
-        try:
-            req = request.Request(
-                mirror + query,
-                headers=pirate.data.default_headers)
-            try:
-                f = request.urlopen(req, timeout=timeout)
-            except urllib.error.URLError as e:
-                raise e
 
-            if f.info().get('Content-Encoding') == 'gzip':
-                f = gzip.GzipFile(fileobj=BytesIO(f.read()))
-        except KeyboardInterrupt:
-            printer.print('\nCancelled.')
-            sys.exit(0)
+# the results of a page as they are read from the mirror
+def stream_page(mode, page, category, terms, mirror, timeout,
+                cache_dir=None):
+    url = mirror + build_request_path(mode, page, category, terms)
+    entry, body = pirate.responses.get(cache_dir, url)
+    if entry is not None and pirate.responses.fresh(entry, mode):
+        pirate.responses.touch(cache_dir, url)
+        yield from iter_page(BytesIO(body))
+        return
 
-        results.extend(parse_page(f))
+    # an older reply is only downloaded again if it changed
+    headers = None
+    if entry is not None:
+        headers = pirate.responses.request_headers(entry)
+    try:
+        f = pirate.net.fetch(url, timeout, headers)
+    except urllib.error.HTTPError as e:
+        if e.code == 304 and entry is not None:
+            pirate.responses.touch(cache_dir, url, revalidated=True)
+            yield from iter_page(BytesIO(body))
+            return
+        raise
+
+    # decompressed as it is parsed, without buffering the whole reply.
+    # what follows the array is read too, so the connection is reused
+    headers = f.info()
+    spool = pirate.responses.spool(cache_dir)
+    if spool is None:
+        with f:
+            yield from iter_page(f)
+            f.read()
+        return
+
+    # the reply is written to the cache as it is read, and only kept
+    # once it parsed, an error page isn't worth keeping
+    recorder = Recorder(f, spool)
+    try:
+        with f:
+            yield from iter_page(recorder)
+            recorder.read()
+        pirate.responses.commit(cache_dir, url, spool, headers.get('ETag'),
+                                headers.get('Last-Modified'))
+    finally:
+        if not spool.closed:
+            pirate.responses.discard(spool)
+
+
+def fetch_page(mode, page, category, terms, mirror, timeout,
+               cache_dir=None):
+    return list(stream_page(mode, page, category, terms, mirror, timeout,
+                            cache_dir))
+
+
+# copies what is read from a file to another one
+class Recorder:
+    def __init__(self, f, out):
+        self.f = f
+        self.out = out
+
+    def read(self, size=-1):
+        chunk = self.f.read(size)
+        self.out.write(chunk)
+        return chunk
+
+
+# run fn(*args) on a daemon thread and return a future of its result.
+# a fetch nobody waits for any more can't hold up the exit of the
+# process like the threads of an executor do
+def in_background(fn, *args):
+    def run():
+        try:
+            future.set_result(fn(*args))
+        except BaseException as e:
+            future.set_exception(e)
+
+    future = concurrent.futures.Future()
+    future.set_running_or_notify_cancel()
+    threading.Thread(target=run, daemon=True).start()
+    return future
+
+
+# the results of every page as a list per page, in page order. pages
+# are fetched concurrently, at most fetch_workers ahead of the one read.
+# once the cancel event is set no more pages are started
+def iter_pages(pages, category, mode, terms, mirror, timeout,
+               cache_dir=None, cancel=None):
+    if pages == 1:
+        # no threads that could outlive a cancelled mirror race
+        yield fetch_page(mode, 1, category, terms, mirror, timeout,
+                         cache_dir)
+        return
+
+    futures = collections.deque()
+    for i in range(1, pages + 1):
+        if cancel is not None and cancel.is_set():
+            raise IOError('cancelled')
+        futures.append(in_background(fetch_page, mode, i, category, terms,
+                                     mirror, timeout, cache_dir))
+        if len(futures) == fetch_workers:
+            # the first failing page raises, the pages still being
+            # fetched are left to their threads
+            yield futures.popleft().result()
+    while futures:
+        yield futures.popleft().result()
+
+
+# the results of every page in page order, as soon as they are read. a
+# single page is streamed as it downloads
+def iter_remote(pages, category, mode, terms, mirror, timeout,
+                cache_dir=None, cancel=None):
+    if pages == 1:
+        yield from stream_page(mode, 1, category, terms, mirror, timeout,
+                               cache_dir)
+        return
+    for page in iter_pages(pages, category, mode, terms, mirror, timeout,
+                           cache_dir, cancel):
+        yield from page
+
+
+# the first limit results in sort order, or all of them
+def remote(printer, pages, category, sort, mode, terms, mirror, timeout,
+           cache_dir=None, limit=None, cancel=None):
+    # Catch the Ctrl-C exception and exit cleanly
+    try:
+        results = list(iter_pages(pages, category, mode, terms, mirror,
+                                  timeout, cache_dir, cancel))
+    except KeyboardInterrupt:
+        printer.print('\nCancelled.')
+        sys.exit(0)
 
-    return sort_results(sort, results)
+    return merge_pages(sort, results, limit)
 
 
 def find_api(mirror, timeout):
     # try common paths
     for path in ['', '/apip', '/api.php?url=']:
-        req = request.Request(mirror + path + '/q.php?q=test&cat=0',
-                              headers=pirate.data.default_headers)
         try:
-            f = request.urlopen(req, timeout=timeout)
+            with pirate.net.fetch(mirror + path + '/q.php?q=test&cat=0',
+                                  timeout) as f:
+                # read to the end, the connection is reused for the search
+                f.read()
             if f.info().get_content_type() == 'application/json':
                 return mirror + path
         except urllib.error.HTTPError as e:
@@ -152,12 +461,11 @@ def find_api(mirror, timeout):
                 raise IOError('Cloudflare protected')
 
     # extract api path from main.js
-    req = request.Request(mirror + '/static/main.js',
-                          headers=pirate.data.default_headers)
     try:
-        f = request.urlopen(req, timeout=timeout)
+        with pirate.net.fetch(mirror + '/static/main.js', timeout) as f:
+            script = f.read().decode('utf-8', 'replace')
         if f.info().get_content_type() == 'application/javascript':
-            match = re.search("var server='([^']+)'", f.read().decode())
+            match = re.search("var server='([^']+)'", script)
             return mirror + match.group(1)
     except urllib.error.URLError:
         raise IOError('API not found: no main.js')
@@ -165,34 +473,152 @@ def find_api(mirror, timeout):
     raise IOError('API not found')
 
 
-def get_torrent(info_hash, timeout):
-    url = 'http://itorrents.org/torrent/{:X}.torrent'
-    req = request.Request(url.format(info_hash),
-                          headers=pirate.data.default_headers)
-    req.add_header('Accept-encoding', 'gzip')
+# torrents are downloaded concurrently by at most this many threads
+download_workers = 4
 
-    torrent = request.urlopen(req, timeout=timeout)
-    if torrent.info().get('Content-Encoding') == 'gzip':
-        torrent = gzip.GzipFile(fileobj=BytesIO(torrent.read()))
+# attempts per torrent, waiting a random time of up to backoff seconds
+# before the second one, doubling before each one after that
+download_attempts = 3
+backoff = 1.0
 
-    return torrent.read()
+# saved torrents get the mode open() would give them. the umask can only
+# be read by setting it, which isn't safe once downloads run on several
+# threads, so it is read once here
+umask = os.umask(0)
+os.umask(umask)
 
 
-def save_torrents(printer, chosen_links, results, folder, timeout):
-    for link in chosen_links:
-        result = results[link]
-        torrent_name = result['name'].replace('/', '_').replace('\\', '_')
-        file = os.path.join(folder, torrent_name + '.torrent')
+def torrent_url(info_hash):
+    return 'http://itorrents.org/torrent/{:X}.torrent'.format(info_hash)
+
+
+def open_torrent(info_hash, timeout):
+    return pirate.net.fetch(torrent_url(info_hash), timeout)
+
+
+# the reply itorrents gave the last time it didn't have the torrent
+def missing_torrent(info_hash):
+    return urllib.error.HTTPError(torrent_url(info_hash), 404, 'Not Found',
+                                  {}, None)
+
+
+# the torrent open from the store or itorrents, and whether it was
+# stored. itorrents isn't asked again for a torrent it doesn't have
+def find_torrent(info_hash, timeout, cache_dir=None):
+    stored = pirate.torrents.get(cache_dir, info_hash)
+    if stored is not None:
+        return stored, True
+    if pirate.torrents.missing(cache_dir, info_hash):
+        raise missing_torrent(info_hash)
+    try:
+        return open_torrent(info_hash, timeout), False
+    except urllib.error.HTTPError as e:
+        if e.code == 404:
+            pirate.torrents.put_missing(cache_dir, info_hash)
+        raise
 
+
+# errors that may go away if the download is tried again
+def transient(error):
+    if isinstance(error, urllib.error.HTTPError):
+        return error.code == 429 or error.code >= 500
+    return isinstance(error, (urllib.error.URLError, OSError))
+
+
+# stream f into a temporary file next to file and rename it into place,
+# so file is either complete or not there at all
+def save_stream(f, file):
+    tmp = None
+    try:
+        with f, tempfile.NamedTemporaryFile(
+                'wb', dir=os.path.dirname(file) or '.',
+                suffix='.tmp', delete=False) as tmp:
+            shutil.copyfileobj(f, tmp, pirate.net.chunk_size)
+        # temporary files are private, a torrent client running as
+        # another user may watch the directory
+        os.chmod(tmp.name, 0o666 & ~umask)
+        os.replace(tmp.name, file)
+    except BaseException:
+        if tmp is not None:
+            try:
+                os.remove(tmp.name)
+            except OSError:
+                pass
+        raise
+
+
+def download_torrent(info_hash, file, timeout, cache_dir=None):
+    for attempt in range(download_attempts):
+        if attempt:
+            time.sleep(random.uniform(0, backoff * 2 ** (attempt - 1)))
         try:
-            torrent = get_torrent(result['info_hash'], timeout)
-        except urllib.error.HTTPError as e:
-            printer.print('There is no cached file for this torrent :('
-                          ' \nCode: {} - {}'.format(e.code, e.reason),
+            f, stored = find_torrent(info_hash, timeout, cache_dir)
+            save_stream(f, file)
+            break
+        except Exception as e:
+            if not transient(e) or attempt == download_attempts - 1:
+                raise
+
+    if not stored and cache_dir is not None:
+        with open(file, 'rb') as f:
+            pirate.torrents.put(cache_dir, info_hash, f)
+
+
+def torrent_file(folder, result):
+    torrent_name = result['name'].replace('/', '_').replace('\\', '_')
+    return os.path.join(folder, torrent_name + '.torrent')
+
+
+# the .torrent of result saved in folder or stored in the cache, open,
+# or None
+def saved_torrent(result, folder=None, cache_dir=None):
+    if cache_dir is not None:
+        stored = pirate.torrents.get(cache_dir, result['info_hash'])
+        if stored is not None:
+            return stored
+    if folder is not None:
+        try:
+            return open(torrent_file(folder, result), 'rb')
+        except OSError:
+            pass
+    return None
+
+
+def save_torrents(printer, chosen_links, results, folder, timeout,
+                  cache_dir=None):
+    files = [(results[link], torrent_file(folder, results[link]))
+             for link in chosen_links]
+
+    failed = []
+    workers = min(len(files), download_workers) or 1
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        futures = {pool.submit(download_torrent, result['info_hash'], file,
+                               timeout, cache_dir): (result, file)
+                   for result, file in files}
+        for future in concurrent.futures.as_completed(futures):
+            result, file = futures[future]
+            try:
+                future.result()
+            except urllib.error.HTTPError as e:
+                printer.print('There is no cached file for this torrent :('
+                              ' \nCode: {} - {}'.format(e.code, e.reason),
+                              color='ERROR')
+                failed.append((file, '{} {}'.format(e.code, e.reason)))
+            except Exception as e:
+                printer.print('Could not save {:X}: {}'.format(
+                    result['info_hash'], e), color='ERROR')
+                failed.append((file, str(e)))
+            else:
+                printer.print('Saved {:X} in {}'.format(result['info_hash'],
+                                                        file))
+
+    if len(files) > 1:
+        printer.print('Saved {} of {} torrents'.format(
+            len(files) - len(failed), len(files)),
+            color='ERROR' if failed else None)
+        for file, reason in sorted(failed):
+            printer.print('  failed: {} ({})'.format(file, reason),
                           color='ERROR')
-        else:
-            open(file, 'wb').write(torrent)
-            printer.print('Saved {:X} in {}'.format(result['info_hash'], file))
 
 
 def save_magnets(printer, chosen_links, results, folder):
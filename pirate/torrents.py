@@ -0,0 +1,102 @@
+import os
+import time
+import shutil
+import tempfile
+import threading
+
+import pirate.cache
+
+
+# the least recently used torrents are dropped past this many bytes
+max_size = 64 << 20
+
+# seconds a torrent itorrents doesn't have is not asked for again
+missing_ttl = 24 * 3600
+
+# torrents are saved from several threads
+lock = threading.Lock()
+
+
+# torrents are kept in the torrents directory of the cache, named after
+# their info hash. torrents.json has, by info hash:
+#   size  the size of the file
+#   used  when it was last read or stored, for the lru eviction
+# and missing.json the info hashes itorrents had no file for
+def key(info_hash):
+    return '{:X}'.format(info_hash)
+
+
+def path(directory, info_hash):
+    return os.path.join(directory, 'torrents', key(info_hash) + '.torrent')
+
+
+# the stored torrent as an open binary file, or None
+def get(directory, info_hash):
+    if directory is None:
+        return None
+    with lock:
+        index = pirate.cache.load(directory, 'torrents')
+        if key(info_hash) not in index:
+            return None
+        try:
+            f = open(path(directory, info_hash), 'rb')
+        except OSError:
+            # removed by another process sharing the directory
+            del index[key(info_hash)]
+            pirate.cache.save(directory, 'torrents', index)
+            return None
+        index[key(info_hash)]['used'] = time.time()
+        pirate.cache.save(directory, 'torrents', index)
+        return f
+
+
+# store the torrent read from f
+def put(directory, info_hash, f):
+    if directory is None:
+        return
+    folder = os.path.join(directory, 'torrents')
+    try:
+        os.makedirs(folder, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+                'wb', dir=folder, suffix='.tmp', delete=False) as tmp:
+            shutil.copyfileobj(f, tmp)
+        # other users may share the directory
+        os.chmod(tmp.name, 0o644)
+        os.replace(tmp.name, path(directory, info_hash))
+        size = os.path.getsize(path(directory, info_hash))
+    except OSError:
+        return
+    with lock:
+        index = pirate.cache.load(directory, 'torrents')
+        index[key(info_hash)] = {'size': size, 'used': time.time()}
+        evict(directory, index)
+        pirate.cache.save(directory, 'torrents', index)
+        pirate.cache.delete(directory, 'missing', key(info_hash))
+
+
+def evict(directory, index):
+    total = sum(entry['size'] for entry in index.values())
+    for name in sorted(index, key=lambda name: index[name]['used']):
+        if total <= max_size:
+            break
+        total -= index.pop(name)['size']
+        try:
+            os.remove(path(directory, int(name, 16)))
+        except OSError:
+            pass
+
+
+def missing(directory, info_hash):
+    return pirate.cache.get(directory, 'missing', key(info_hash),
+                            missing_ttl) is not None
+
+
+def put_missing(directory, info_hash):
+    with lock:
+        # expired entries are dropped so the file doesn't keep growing
+        now = time.time()
+        data = {name: entry for name, entry
+                in pirate.cache.load(directory, 'missing').items()
+                if now - entry['time'] < missing_ttl}
+        data[key(info_hash)] = {'value': True, 'time': now}
+        pirate.cache.save(directory, 'missing', data)
@@ -25,6 +25,7 @@ if __name__ == '__main__':
         install_requires=['colorama>=0.3.3',
                           'veryprettytable>=0.8.1',
                           'pyperclip>=1.6.2'],
+        extras_require={'numpy': ['numpy']},
         keywords=['torrent', 'magnet', 'download', 'tpb', 'client'],
         classifiers=[
             'Topic :: Utilities',
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+import unittest
+import hashlib
+import tempfile
+
+import pirate.bencode
+
+
+def torrent(info):
+    return pirate.bencode.encode({'announce': 'udp://tracker:80',
+                                  'info': info})
+
+
+class TestBencode(unittest.TestCase):
+
+    def test_decode(self):
+        value = pirate.bencode.decode(
+            b'd1:ai-12e1:bl3:abci0ee1:cd0:0:ee')
+        self.assertEqual(value[b'a'], -12)
+        self.assertEqual(bytes(value[b'b'][0]), b'abc')
+        self.assertEqual(value[b'b'][1], 0)
+        self.assertEqual(bytes(value[b'c'][b'']), b'')
+
+        # strings are views of the data, not copies
+        data = bytearray(b'5:hello')
+        value = pirate.bencode.decode(data)
+        self.assertIsInstance(value, memoryview)
+        data[2] = ord('j')
+        self.assertEqual(bytes(value), b'jello')
+        value.release()
+
+        for value in [0, -1, b'', b'x' * 300, [], {}, [[1, {b'k': []}]],
+                      {b'a': 1, b'b': [b'c', 2]}]:
+            encoded = pirate.bencode.encode(value)
+            self.assertEqual(pirate.bencode.encode(
+                pirate.bencode.decode(encoded)), encoded)
+
+    def test_decode_invalid(self):
+        invalid = [b'', b'i12', b'i1x2e', b'ie', b'i-0e', b'i03e', b'5:abc',
+                   b'l1:a', b'd1:a', b'di1ei2ee', b'x', b'i1ei2e', b'3x:abc',
+                   b'l' * 100 + b'e' * 100]
+        for data in invalid:
+            with self.assertRaises(ValueError, msg=data):
+                pirate.bencode.decode(data)
+
+    def test_torrent_info(self):
+        info = {'name': 'album', 'piece length': 1 << 18,
+                'pieces': b'\xff' * 40,
+                'files': [{'length': 10, 'path': ['cd1', '01.flac']},
+                          {'length': 20, 'path': ['cover.jpg']}]}
+        data = torrent(info)
+        expected = int(hashlib.sha1(pirate.bencode.encode(info)).hexdigest(),
+                       16)
+        self.assertEqual(pirate.bencode.torrent_info(data), {
+            'name': 'album',
+            'piece_length': 1 << 18,
+            'files': [('album/cd1/01.flac', 10), ('album/cover.jpg', 20)],
+            'info_hash': expected,
+        })
+
+        single = pirate.bencode.torrent_info(torrent(
+            {'name': 'ubuntu.iso', 'length': 1 << 31, 'pieces': b''}))
+        self.assertEqual(single['files'], [('ubuntu.iso', 1 << 31)])
+
+        invalid = [b'le', b'de', torrent('x'), torrent({'name': 'a'}),
+                   torrent({'name': 'a', 'files': [{'length': 1}]}),
+                   torrent({'name': 'a', 'files': [{'path': [1],
+                                                    'length': 1}]})]
+        for data in invalid:
+            with self.assertRaises(ValueError, msg=data):
+                pirate.bencode.torrent_info(data)
+
+    def test_read_info(self):
+        info = {'name': 'a', 'length': 5, 'pieces': b'\0' * 20}
+        with tempfile.TemporaryFile() as f:
+            f.write(torrent(info))
+            f.flush()
+            self.assertEqual(pirate.bencode.read_info(f)['files'],
+                             [('a', 5)])
+
+            f.write(b'junk')
+            f.flush()
+            with self.assertRaises(ValueError):
+                pirate.bencode.read_info(f)
+
+        with tempfile.TemporaryFile() as f:
+            with self.assertRaises(ValueError):
+                pirate.bencode.read_info(f)
+
+
+if __name__ == '__main__':
+    unittest.main()
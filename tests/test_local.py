@@ -1,8 +1,20 @@
 #!/usr/bin/env python3
 import unittest
+from unittest import mock
 import pirate.local
+import pirate.index
+import pirate.store
+import pirate.sidecar
+import pirate.batch
 import os
+import gzip
+import lzma
+import bz2
 import base64
+import shutil
+import math
+import random
+import tempfile
 
 from tests import util
 
@@ -13,16 +25,19 @@ class TestLocal(unittest.TestCase):
         path = util.data_path('db.csv')
         expected = [
                 {
+                    'name': 'ubuntu-14.04.5-desktop-amd64.iso',
                     'date':'2018-May-14 11:05:31',
                     'magnet': 'magnet:?xt=urn:btih:34930674EF3BB9317FB5F263CCA830F52685235B&dn=ubuntu-14.04.5-desktop-amd64.iso',
                     'size': '1.0 GiB',
                 },
                 {
+                    'name': 'Ubuntu 17.10.1 Desktop (amd64)',
                     'date': '2018-Apr-15 00:04:09',
                     'magnet': 'magnet:?xt=urn:btih:F07E0B0584745B7BCB35E98097488D34E68623D0&dn=Ubuntu%2017.10.1%20Desktop%20%28amd64%29',
                     'size': '1.4 GiB',
                 },
                 {
+                    'name': 'LINUX UBUNTU 16.10 32X64',
                     'date': '2017-Aug-01 15:08:07',
                     'magnet': 'magnet:?xt=urn:btih:4096EC129404689CEB8056D907E384FF872C2CE9&dn=LINUX%20UBUNTU%2016.10%2032X64',
                     'size': '1.5 GiB',
@@ -33,5 +48,453 @@ class TestLocal(unittest.TestCase):
         for i in range(len(expected)):
             self.assertDictEqual(actual[i], expected[i])
 
+    def test_sort_and_pages(self):
+        path = util.data_path('db.csv')
+
+        def names(**kwargs):
+            return [r['name'][:6]
+                    for r in pirate.local.search(path, ('a',), **kwargs)]
+
+        self.assertEqual(names(), ['ubuntu', 'Ubuntu', 'Ron Wh',
+                                   'Lovita', 'A.Retu'])
+        self.assertEqual(names(sort=['raw_size', True]),
+                         ['Lovita', 'A.Retu', 'Ubuntu', 'ubuntu', 'Ron Wh'])
+        self.assertEqual(names(sort=['raw_uploaded', False], limit=2),
+                         ['Ron Wh', 'Ubuntu'])
+        self.assertEqual(names(sort=['raw_uploaded', False], limit=2,
+                               page=2),
+                         ['ubuntu', 'Lovita'])
+        self.assertEqual(names(sort=['name', False], limit=2, page=3),
+                         ['ubuntu'])
+        self.assertEqual(names(limit=2, page=4), [])
+        self.assertEqual(names(limit=None), names())
+        # sort keys the dump doesn't have keep the file order
+        self.assertEqual(names(sort=['seeders', True], limit=3),
+                         ['ubuntu', 'Ubuntu', 'Ron Wh'])
+        self.assertEqual(names(sort=['raw_size', False], limit=3,
+                               workers=2),
+                         names(sort=['raw_size', False], limit=3))
+        self.assertEqual(names(limit=2, page=2, workers=2),
+                         ['Ron Wh', 'Lovita'])
+
+        # unsorted pages skip the rows before them instead of keeping them
+        items = iter(range(100))
+        self.assertEqual(pirate.local.select(items, {}, None, 30, 20),
+                         list(range(20, 30)))
+        self.assertEqual(next(items), 30)
+        self.assertEqual(pirate.local.select(
+            iter(range(10)), {'n': lambda x: -x}, ('n', False), 6, 4),
+            [5, 4])
+
+        with tempfile.TemporaryDirectory() as tmp:
+            db = os.path.join(tmp, 'db.csv')
+            shutil.copy(path, db)
+            tests = [{'sort': ['raw_size', True]},
+                     {'sort': ['name', False], 'limit': 2, 'page': 2},
+                     {'sort': ['category', False], 'limit': 3}]
+            expected = [pirate.local.search(path, ('ubuntu',), **kwargs)
+                        for kwargs in tests]
+            for build in [pirate.index.build, pirate.store.build]:
+                build(db)
+                for kwargs, results in zip(tests, expected):
+                    self.assertEqual(
+                        pirate.local.search(db, ('ubuntu',), **kwargs),
+                        results)
+
+    def test_scan(self):
+        path = util.data_path('db.csv')
+        queries = ['ubuntu', 'x264', 'salad', 'cruz)\\', 'nothing', '\u00fc']
+        for query in queries:
+            expected = list(pirate.local.scan_text(path, query))
+            self.assertEqual(list(pirate.local.scan(path, query)), expected)
+            # lines must not get lost at block boundaries
+            with mock.patch('pirate.local.block_size', 1):
+                self.assertEqual(list(pirate.local.scan(path, query)),
+                                 expected)
+
+    def test_parallel_scan(self):
+        path = util.data_path('db.csv')
+        expected = list(pirate.local.scan(path, 'a'))
+        self.assertEqual(len(expected), 5)
+        for workers in [2, 3, 0]:
+            actual = list(pirate.local.scan(path, 'a', workers))
+            self.assertEqual(actual, expected)
+
+    def test_compressed_scan(self):
+        path = util.data_path('db.csv')
+        with open(path, 'rb') as f:
+            data = f.read()
+        queries = ['ubuntu', 'a', 'cruz)\\', 'nothing', '\u00fc']
+        with tempfile.TemporaryDirectory() as tmp:
+            for ext, module in [('.gz', gzip), ('.xz', lzma), ('.bz2', bz2)]:
+                compressed = os.path.join(tmp, 'db.csv' + ext)
+                with module.open(compressed, 'wb') as f:
+                    f.write(data)
+                self.assertTrue(pirate.local.is_compressed(compressed))
+                for query in queries:
+                    expected = list(pirate.local.scan(path, query))
+                    for size in [pirate.local.block_size, 1, 100]:
+                        with mock.patch('pirate.local.block_size', size):
+                            actual = pirate.local.scan(compressed, query, 2)
+                        self.assertEqual(actual, expected)
+                self.assertEqual(
+                    pirate.local.search(compressed, ['ubuntu']),
+                    pirate.local.search(path, ['ubuntu']))
+        self.assertFalse(pirate.local.is_compressed(path))
+
+    def test_split(self):
+        path = util.data_path('db.csv')
+        with open(path, 'rb') as f:
+            data = f.read()
+        for parts in [1, 2, 5, 100]:
+            ranges = pirate.local.split(path, parts)
+            self.assertEqual(ranges[0][0], 0)
+            self.assertEqual(ranges[-1][1], len(data))
+            for start, end in ranges:
+                self.assertLess(start, end)
+                self.assertEqual(data[end - 1:end], b'\n')
+
+    def test_index(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'db.csv')
+            shutil.copy(util.data_path('db.csv'), path)
+            expected = pirate.local.search(path, ('ubuntu',))
+
+            self.assertIsNone(pirate.index.open_index(path))
+            self.assertEqual(pirate.index.build(path), 6)
+            with pirate.index.open_index(path) as index:
+                self.assertEqual(len(list(index.search('ubuntu'))), 3)
+                self.assertEqual(list(index.search('desktop (amd64)')),
+                                 [pirate.local.parse_line(
+                                     '2018-Apr-15 00:04:09;'
+                                     '8H4LBYR0W3vLNemAl0iNNOaGI9A=;'
+                                     '"Ubuntu 17.10.1 Desktop (amd64)";'
+                                     '1502576640')])
+                self.assertEqual(list(index.search('nothing')), [])
+            self.assertEqual(pirate.local.search(path, ('ubuntu',)),
+                             expected)
+
+            # not a whole word, still found through the index
+            with mock.patch('pirate.local.scan') as scan:
+                actual = pirate.local.search(path, ('buntu',))
+                scan.assert_not_called()
+            self.assertEqual(actual, expected)
+
+            # stale indexes are ignored
+            with open(path, 'a') as f:
+                f.write('2018-May-14 11:05:31;NJMGdO87uTF/tfJjzKgw9SaFI1s=;'
+                        '"kubuntu";1\n')
+            self.assertIsNone(pirate.index.open_index(path))
+            self.assertEqual(len(pirate.local.search(path, ('ubuntu',))), 4)
+
+    def test_index_substrings(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'db.csv')
+            with open(path, 'w') as f:
+                f.write('2018-May-14 11:05:31;NJMGdO87uTF/tfJjzKgw9SaFI1s=;'
+                        '"Kubuntu 18.04 desktop";1\n'
+                        '2018-Apr-15 00:04:09;8H4LBYR0W3vLNemAl0iNNOaGI9A=;'
+                        '"Ubuntu 17.10.1 Desktop";2\n')
+            queries = ['ubuntu', 'kubuntu', 'buntu 1', 'esk', '8.04 desk',
+                       '0.1 d', 'u 1', 'desktop', 'top', 'ubuntux', '.', '']
+            expected = [pirate.local.search(path, (q,)) for q in queries]
+            self.assertEqual(len(expected[0]), 2)
+
+            pirate.index.build(path)
+            for query, results in zip(queries, expected):
+                self.assertEqual(pirate.local.search(path, (query,)),
+                                 results, query)
+
+            # a hit across two tokens of the lexicon is no hit
+            with pirate.index.open_index(path) as index:
+                self.assertEqual(list(index.search('ntuub')), [])
+                self.assertEqual(list(index.search('18desk')), [])
+
+    def test_folded_characters(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'db.csv')
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write('2018-May-14 11:05:31;NJMGdO87uTF/tfJjzKgw9SaFI1s=;'
+                        '"\u212a9 Movie";1\n'
+                        '2018-Apr-15 00:04:09;8H4LBYR0W3vLNemAl0iNNOaGI9A=;'
+                        '"\u0130stanbul Kite";2\n')
+            # the kelvin sign and dotted i lowercase to ascii letters
+            queries = {'k9': 1, 'k': 2, 'ite': 1, 'i': 2, 'movie': 1}
+            for query, count in queries.items():
+                expected = list(pirate.local.scan_text(path, query))
+                self.assertEqual(len(expected), count, query)
+                self.assertEqual(list(pirate.local.scan(path, query)),
+                                 expected, query)
+
+            pirate.store.build(path)
+            for query, count in queries.items():
+                self.assertEqual(
+                    len(pirate.local.search(path, (query,))), count, query)
+
+    def test_store(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'db.csv')
+            shutil.copy(util.data_path('db.csv'), path)
+            queries = ['ubuntu', 'a', 'salad', '\u00fc', '']
+            expected = [pirate.local.search(path, (q,)) for q in queries]
+
+            self.assertIsNone(pirate.store.open_store(path))
+            self.assertEqual(pirate.store.build(path), 6)
+            self.assertIsNotNone(pirate.store.open_store(path))
+            for query, results in zip(queries, expected):
+                self.assertEqual(pirate.local.search(path, (query,)),
+                                 results)
+
+    def test_store_and_index(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'db.csv')
+            shutil.copy(util.data_path('db.csv'), path)
+            queries = ['ubuntu', 'buntu', 'desktop (amd64)', 'a', 'salad',
+                       '\u00fc', '.', '']
+            options = [{}, {'size': (1 << 30, None)},
+                       {'sort': ('raw_size', True), 'limit': 2}]
+            cases = [(q, o) for q in queries for o in options]
+            expected = [pirate.local.search(path, (q,), **o)
+                        for q, o in cases]
+
+            pirate.store.build(path)
+            pirate.index.build(path)
+            match = pirate.store.Store.match
+            used = []
+
+            def spy(store, query, candidates=None):
+                used.append(candidates is not None)
+                return match(store, query, candidates)
+
+            with mock.patch('pirate.store.Store.match', spy):
+                for (query, kwargs), results in zip(cases, expected):
+                    self.assertEqual(
+                        pirate.local.search(path, (query,), **kwargs),
+                        results, query)
+            # queries with a word go through the index
+            self.assertEqual(used, [bool(pirate.index.tokenize(q))
+                                    for q, _ in cases])
+
+    def test_filters(self):
+        path = util.data_path('db.csv')
+        may = (pirate.local.parse_date('2018-May-01 00:00:00'),
+               pirate.local.parse_date('2018-Jun-01 00:00:00'))
+        tests = [
+            ({}, 5),
+            ({'size': (1 << 30, None)}, 4),
+            ({'size': (None, 1 << 30)}, 1),
+            ({'date': may}, 3),
+            ({'size': (1 << 31, None), 'date': may}, 1),
+        ]
+        with tempfile.TemporaryDirectory() as tmp:
+            db = os.path.join(tmp, 'db.csv')
+            shutil.copy(path, db)
+            for kwargs, count in tests:
+                self.assertEqual(
+                    len(pirate.local.search(path, ('a',), **kwargs)), count)
+            pirate.store.build(db)
+            for kwargs, count in tests:
+                self.assertEqual(
+                    len(pirate.local.search(db, ('a',), **kwargs)), count)
+            with mock.patch('pirate.store.numpy', None):
+                for kwargs, count in tests:
+                    self.assertEqual(
+                        len(pirate.local.search(db, ('a',), **kwargs)), count)
+
+    def test_parse_hash(self):
+        raw = bytes.fromhex('34930674EF3BB9317FB5F263CCA830F52685235B')
+        tests = [
+            '34930674EF3BB9317FB5F263CCA830F52685235B',
+            '34930674ef3bb9317fb5f263cca830f52685235b\n',
+            'GSJQM5HPHO4TC75V6JR4ZKBQ6UTIKI23',
+            'magnet:?xt=urn:btih:34930674EF3BB9317FB5F263CCA830F52685235B'
+            '&dn=ubuntu',
+        ]
+        for text in tests:
+            self.assertEqual(pirate.local.parse_hash(text), raw)
+        for text in ['', 'abc', '34930674EF3BB9317FB5F263CCA830F52685235']:
+            with self.assertRaises(ValueError):
+                pirate.local.parse_hash(text)
+
+    def test_lookup(self):
+        hashes = [bytes.fromhex(h) for h in [
+            '4096EC129404689CEB8056D907E384FF872C2CE9',
+            '0000000000000000000000000000000000000000',
+            '34930674EF3BB9317FB5F263CCA830F52685235B',
+            '7F403A22CA6EA0177C05BFEE2E16AA3D92E18D87']]
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'db.csv')
+            shutil.copy(util.data_path('db.csv'), path)
+            for build in [None, pirate.index.build]:
+                if build:
+                    build(path)
+                results, missing = pirate.local.lookup(path, hashes)
+                self.assertEqual([r['name'][:6] for r in results],
+                                 ['LINUX ', 'ubuntu', 'A.Retu'])
+                self.assertEqual(missing, [hashes[1]])
+            with pirate.index.open_index(path) as index:
+                for info_hash in hashes:
+                    row = index.find(info_hash)
+                    if row is not None:
+                        self.assertEqual(
+                            base64.b64decode(row[1]), info_hash)
+                self.assertIsNone(index.find(b'\xff' * 20))
+
+    def test_automaton(self):
+        rng = random.Random(0)
+        patterns = [''.join(rng.choice('abc')
+                            for _ in range(rng.randint(1, 4)))
+                    for _ in range(30)]
+        automaton = pirate.batch.Automaton(patterns)
+        for _ in range(200):
+            text = ''.join(rng.choice('abcd') for _ in range(20))
+            self.assertEqual(
+                automaton.search(text),
+                {i for i, p in enumerate(patterns) if p in text})
+        self.assertEqual(pirate.batch.Automaton(['', 'x']).search('y'), {0})
+
+    def test_batch(self):
+        queries = ['ubuntu', 'Desktop', 'a', 'ubuntu', 'nothing', 'écrit']
+        path = util.data_path('db.csv')
+        found = list(pirate.batch.search(path, queries))
+        for query in set(queries):
+            expected = [pirate.local.build_result(row) for row in
+                        pirate.local.scan(path, query.lower())]
+            expected = [r for r in expected
+                        for _ in range(queries.count(query))]
+            self.assertEqual([r for q, r in found if q == query], expected)
+        # every row comes once, with all the queries it matches
+        self.assertEqual([q for q, r in found if 'ubuntu' in r['name']][:4],
+                         ['ubuntu', 'Desktop', 'a', 'ubuntu'])
+
+    def test_incremental_builds(self):
+        rows = [
+            '2019-Jan-01 00:00:00;MzMzMzMzMzMzMzMzMzMzMzMzMzM=;'
+            '"ubuntu appended";1\n',
+            '2019-Jan-02 00:00:00;REREREREREREREREREREREREREQ=;'
+            '"another ubuntu";2\n',
+        ]
+        hashes = [b'3' * 20, b'D' * 20]
+
+        def check(path, rows, segments):
+            meta = pirate.sidecar.read_meta(pirate.index.index_path(path))
+            self.assertEqual(len(meta['segments']), segments)
+            self.assertEqual(meta['rows'], rows)
+            meta = pirate.sidecar.read_meta(pirate.store.store_path(path))
+            self.assertEqual(meta['rows'], rows)
+
+        def build(path):
+            return (pirate.index.build(path), pirate.store.build(path))
+
+        def search(path):
+            return (pirate.local.search(path, ('ubuntu',)),
+                    pirate.local.lookup(path, hashes))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'db.csv')
+            shutil.copy(util.data_path('db.csv'), path)
+            self.assertEqual(build(path), (6, 6))
+            check(path, 6, 1)
+
+            # only the appended rows get processed
+            with open(path, 'a') as f:
+                f.write(rows[0])
+            expected = search(path)
+            self.assertEqual(build(path), (1, 1))
+            check(path, 7, 2)
+            self.assertEqual(search(path), expected)
+
+            # unfinished lines wait for the next build
+            with open(path, 'a') as f:
+                f.write(rows[1][:20])
+            self.assertEqual(build(path), (0, 0))
+            check(path, 7, 2)
+            with open(path, 'a') as f:
+                f.write(rows[1][20:])
+            expected = search(path)
+            self.assertEqual(build(path), (1, 1))
+            check(path, 8, 3)
+            self.assertEqual(search(path), expected)
+            self.assertEqual(len(expected[0]), 5)
+            self.assertEqual(expected[1][1], [])
+
+            # rewriting the dump means starting over
+            with open(path, 'r+b') as f:
+                f.readline()
+                f.write(b'#')
+            self.assertEqual(build(path), (7, 7))
+            check(path, 7, 1)
+
+    def test_rank(self):
+        random.seed(4)
+        words = ['ubuntu', 'desktop', 'server', 'amd64', 'i386', 'iso',
+                 'linux', 'debian', 'mint', 'live', 'dvd', 'netinst']
+        rows = []
+        for i in range(600):
+            title = ' '.join(random.choice(words)
+                             for _ in range(random.randint(1, 8)))
+            info_hash = base64.b64encode(i.to_bytes(20, 'big')).decode()
+            rows.append('2018-May-14 11:05:31;{};"{}";{}\n'.format(
+                info_hash, title, i))
+
+        def bm25(titles, query):
+            query = set(pirate.index.tokenize(query))
+            docs = [pirate.index.tokenize(t) for t in titles]
+            average = sum(map(len, docs)) / len(docs)
+            scores = []
+            for i, doc in enumerate(docs):
+                score = 0
+                for token in query:
+                    df = sum(token in d for d in docs)
+                    tf = doc.count(token)
+                    if tf:
+                        idf = math.log(1 + (len(docs) - df + 0.5) / (df + 0.5))
+                        norm = 1.2 * (1 - 0.75 + 0.75 * len(doc) / average)
+                        score += idf * tf * 2.2 / (tf + norm)
+                if score:
+                    scores.append((-round(score, 9), i))
+            return sorted(scores)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'db.csv')
+            with open(path, 'w') as f:
+                f.writelines(rows[:400])
+            pirate.index.build(path)
+            # the rest goes into more segments
+            for chunk in [rows[400:550], rows[550:]]:
+                with open(path, 'a') as f:
+                    f.writelines(chunk)
+                pirate.index.build(path)
+
+            titles = [pirate.local.parse_line(r)[2] for r in rows]
+            with pirate.index.open_index(path) as index:
+                self.assertEqual(len(index.segments), 3)
+                # rows with the same score can come in any order
+                def check(query, count, expected, accept=None):
+                    scores = dict((i, score) for score, i in expected)
+                    actual = [int(r[3]) for r in
+                              index.rank(query, count, accept)]
+                    self.assertEqual([scores[i] for i in actual],
+                                     [score for score, _ in expected[:count]])
+
+                for query in ['ubuntu', 'ubuntu desktop', 'mint dvd live',
+                              'netinst i386 server', 'nothing']:
+                    for count in [1, 10, 1000]:
+                        check(query, count, bm25(titles, query))
+
+                # rejected rows leave their place to the next best ones
+                expected = [(score, i) for score, i in bm25(titles, 'ubuntu')
+                            if i % 2]
+                check('ubuntu', 10, expected, lambda row: int(row[3]) % 2)
+
+            results = pirate.local.search(path, ('mint', 'dvd'), limit=5,
+                                          page=2, ranked=True)
+            self.assertEqual(len(results), 5)
+            self.assertEqual(
+                pirate.local.search(path, ('mint', 'dvd'), limit=10,
+                                    ranked=True)[5:],
+                results)
+
+
 if __name__ == '__main__':
     unittest.main()
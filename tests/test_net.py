@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+import unittest
+from unittest.mock import patch, MagicMock
+import threading
+import io
+import gzip
+import zlib
+import json
+import socket
+import socketserver
+import http.server
+import urllib.request
+import urllib.error
+
+import pirate.net
+import pirate.torrent
+from pirate.print import Printer
+
+
+# http.server.ThreadingHTTPServer needs python 3.7
+class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.clients.add(self.client_address)
+        body = self.path.encode()
+        encoding = None
+        content_type = 'text/plain'
+        if self.path.startswith('/gzip'):
+            encoding = 'gzip'
+            body = gzip.compress(body * 100)
+        elif self.path.startswith('/q.php'):
+            content_type = 'application/json'
+            body = json.dumps([{
+                'id': '1', 'name': self.path, 'size': '1', 'added': '0',
+                'info_hash': 'AA', 'seeders': '1', 'leechers': '0',
+                'category': '100'}] * 50).encode() + b'\n'
+        elif self.path == '/slow':
+            self.server.slow.wait(5)
+        self.send_response(404 if 'missing' in self.path else 200)
+        self.send_header('Content-Type', content_type)
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        self.server.encodings.append(self.headers['Accept-Encoding'])
+        self.send_header('Content-Length', str(len(body)))
+        if self.path == '/close':
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestNet(unittest.TestCase):
+    def setUp(self):
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.server.clients = set()
+        self.server.encodings = []
+        self.server.slow = threading.Event()
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        self.opener = urllib.request.build_opener(
+            pirate.net.KeepAliveHTTPHandler)
+        self.pool = pirate.net.Pool()
+        patcher = patch('pirate.net.pool', self.pool)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.server.slow.set()
+        self.pool.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get(self, path):
+        with self.opener.open(self.url + path, timeout=5) as f:
+            return f.read()
+
+    def test_reuse(self):
+        for path in ['/a', '/b', '/c']:
+            self.assertEqual(self.get(path), path.encode())
+        self.assertEqual(len(self.server.clients), 1)
+        self.assertEqual((self.pool.hits, self.pool.misses), (2, 1))
+
+        # errors are read to the end and leave the connection reusable
+        with self.assertRaises(urllib.error.HTTPError) as e:
+            self.get('/missing')
+        self.assertEqual(e.exception.read(), b'/missing')
+        self.get('/d')
+        self.assertEqual(len(self.server.clients), 1)
+
+    def test_close(self):
+        self.get('/close')
+        self.get('/a')
+        self.assertEqual(len(self.server.clients), 2)
+        self.assertEqual(self.pool.hits, 0)
+
+    def test_dropped(self):
+        self.get('/a')
+        # the idle connection goes away
+        for idle in self.pool.connections.values():
+            for conn in idle:
+                conn.sock.shutdown(socket.SHUT_RDWR)
+        self.assertEqual(self.get('/b'), b'/b')
+        self.assertEqual(len(self.server.clients), 2)
+
+    def test_unread(self):
+        # a reply closed before its end takes its connection with it
+        f = self.opener.open(self.url + '/a', timeout=5)
+        self.assertEqual(self.pool.connections, {})
+        f.read(1)
+        f.close()
+        self.assertEqual(self.pool.connections, {})
+        self.get('/b')
+        self.assertEqual(len(self.server.clients), 2)
+
+        # connections in use aren't idle and can't be evicted
+        with patch('pirate.net.max_idle', 1):
+            replies = [self.opener.open(self.url + '/a', timeout=5)
+                       for _ in range(3)]
+            for f in replies:
+                self.assertEqual(f.read(), b'/a')
+        self.assertEqual(sum(map(len, self.pool.connections.values())), 1)
+
+    def test_probe_then_search(self):
+        with patch('urllib.request.urlopen', self.opener.open):
+            api = pirate.torrent.find_api(self.url, 5)
+            self.assertEqual(api, self.url)
+            for _ in range(2):
+                results = pirate.torrent.remote(
+                    MagicMock(Printer), 1, 0, None, 'search', ['x'], api, 5)
+                self.assertEqual(len(results), 50)
+        self.assertEqual(len(self.server.clients), 1)
+        self.assertEqual((self.pool.hits, self.pool.misses), (2, 1))
+
+    def test_reused_timeout(self):
+        self.get('/a')
+        with self.assertRaises(urllib.error.URLError):
+            self.opener.open(self.url + '/slow', timeout=0.2)
+        # the timeout wasn't taken for a dropped connection and retried
+        self.assertEqual((self.pool.hits, self.pool.misses), (1, 1))
+
+    def test_concurrent(self):
+        def fetch(i):
+            results[i] = self.get('/{}'.format(i))
+        results = {}
+        threads = [threading.Thread(target=fetch, args=(i,))
+                   for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results,
+                         {i: '/{}'.format(i).encode() for i in range(8)})
+        self.assertEqual(self.pool.hits + self.pool.misses, 8)
+
+    def test_fetch(self):
+        with patch('urllib.request.urlopen', self.opener.open), \
+                patch('pirate.net.traffic', pirate.net.Traffic()) as traffic:
+            f = pirate.net.fetch(self.url + '/gzip', 5)
+            self.assertEqual(f.info()['Content-Encoding'], 'gzip')
+            self.assertEqual(f.read(), b'/gzip' * 100)
+            self.assertEqual(traffic.decoded, 500)
+            self.assertLess(traffic.received, 100)
+
+            # error pages are decompressed too
+            with self.assertRaises(urllib.error.HTTPError) as e:
+                pirate.net.fetch(self.url + '/gzip-missing', 5)
+            self.assertEqual(e.exception.fp.read(), b'/gzip-missing' * 100)
+        self.assertEqual(self.server.encodings, ['gzip, deflate'] * 2)
+
+    def test_decompress(self):
+        data = json.dumps(list(range(5000))).encode()
+        raw = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+        encoded = [
+            ('gzip', gzip.compress(data)),
+            ('deflate', zlib.compress(data)),
+            ('deflate', raw.compress(data) + raw.flush()),
+            (None, data),
+            ('identity', data),
+        ]
+        for encoding, body in encoded:
+            headers = {'Content-Encoding': encoding} if encoding else {}
+            f = pirate.net.Response(io.BytesIO(body), headers)
+            self.assertEqual(f.read(), data)
+
+            # a sized read returns what the first chunks decode to
+            with patch('pirate.net.chunk_size', 64):
+                f = pirate.net.Response(io.BytesIO(body), headers)
+                first = f.read(1 << 20)
+                self.assertTrue(data.startswith(first))
+                if encoding in ('gzip', 'deflate'):
+                    self.assertLess(len(first), len(data))
+                rest = iter(lambda: f.read(100), b'')
+                self.assertEqual(first + b''.join(rest), data)
+
+        f = pirate.net.Response(io.BytesIO(b'not gzip'),
+                                {'Content-Encoding': 'gzip'})
+        with self.assertRaises(IOError):
+            f.read(10)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,11 @@
 #!/usr/bin/env python3
 import socket
+import io
+import tempfile
+import functools
+import urllib.error
+import time
+import threading
 import unittest
 from argparse import Namespace
 from unittest import mock
@@ -7,6 +13,8 @@ from unittest.mock import patch, call, MagicMock
 
 import pirate.pirate
 import pirate.data
+import pirate.cache
+import pirate.scoreboard
 from pirate.print import Printer
 
 
@@ -97,6 +105,7 @@ class TestPirate(unittest.TestCase):
             'LocalDB': {
                 'enabled': bool,
                 'path': str,
+                'workers': str,
             }
         }
         config1 = """
@@ -106,6 +115,7 @@ class TestPirate(unittest.TestCase):
         [LocalDB]
         enabled=true
         path=abc
+        workers=4
         """
         config2 = """
         [Save]
@@ -117,6 +127,7 @@ class TestPirate(unittest.TestCase):
             (config1, {'Save': {'directory': 'dir'}}),
             (config1, {'LocalDB': {'enabled': True}}),
             (config1, {'LocalDB': {'path': 'abc'}}),
+            (config1, {'LocalDB': {'workers': '4'}}),
             (config2, {'Save': {'magnets': True}}),
         ]
         for test in tests:
@@ -149,6 +160,28 @@ class TestPirate(unittest.TestCase):
              ['-E', 'localhost:1337'],
              {'transmission_command':
               ['transmission-remote', 'localhost:1337']}),
+            ('', ['--build-index'], {'action': 'build_index'}),
+            ('', ['--compile-db'], {'action': 'compile_db'}),
+            ('', ['-L', 'filename', 'term'], {'page': 1}),
+            ('',
+             ['--hash', 'abc', 'def'],
+             {'action': 'hash_lookup', 'source': 'local_tpb',
+              'hashes': ['abc', 'def']}),
+            ('',
+             ['--hash-file', 'hashes.txt'],
+             {'action': 'hash_lookup', 'hash_file': 'hashes.txt'}),
+            ('',
+             ['--query-file', 'queries.txt'],
+             {'action': 'batch', 'source': 'local_tpb',
+              'query_file': 'queries.txt'}),
+            ('', ['-L', 'filename', 'term', '--page', '3'], {'page': 3}),
+            ('', ['term'], {'size_range': None, 'date_range': None}),
+            ('',
+             ['term', '--min-size', '1k', '--max-size', '1.5 GiB'],
+             {'size_range': (1024, 1610612737)}),
+            ('',
+             ['term', '--after', '2018-05-14'],
+             {'date_range': (1526256000, None)}),
             ('', ['term'], {'output': 'browser_open'}),
             ('', ['term', '-t'], {'output': 'transmission'}),
             ('', ['term', '--save-magnets'], {'output': 'save_magnet_files'}),
@@ -156,6 +189,16 @@ class TestPirate(unittest.TestCase):
              ['term', '-C', 'command'],
              {'output': 'open_command', 'open_command': 'command'}),
             ('', ['internets'], {'action': 'search', 'search': ['internets']}),
+            ('[Cache]\nenabled = false\n', ['term'], {'cache_dir': None}),
+            ('', ['term'], {'race': None}),
+            ('', ['term'], {'sort': 'SeedersDsc', 'jsonl': False}),
+            ('', ['term', '--jsonl'], {'sort': None, 'jsonl': True}),
+            ('', ['term', '--jsonl', '-s', '1'], {'sort': '1'}),
+            ('', ['term', '--race'], {'race': 1.0}),
+            ('', ['term', '--race', '0.3'], {'race': 0.3}),
+            ('[Cache]\ndirectory = /tmp/pirate\napi-ttl = 60\n',
+             ['term'],
+             {'cache_dir': '/tmp/pirate', 'api_ttl': 60}),
             ('',
              ['term', '--save-torrents'],
              {'output': 'save_torrent_files'}),
@@ -176,7 +219,8 @@ class TestPirate(unittest.TestCase):
             category=100, sort=10,
             action='browse', search=[],
             mirror=[pirate.data.default_mirror],
-            timeout=pirate.data.default_timeout)
+            timeout=pirate.data.default_timeout,
+            race=None, cache_dir=None)
 
         class MockResponse():
             readlines = mock.MagicMock(
@@ -202,6 +246,256 @@ class TestPirate(unittest.TestCase):
         self.assertEqual(results, [])
         self.assertEqual(mirror, 'https://example.com')
 
+    def test_connect_mirror_cache(self):
+        printer = MagicMock(Printer)
+        with tempfile.TemporaryDirectory() as tmp:
+            args = Namespace(
+                category=100, sort=10, pages=1,
+                action='browse', search=[],
+                timeout=pirate.data.default_timeout,
+                cache_dir=tmp, api_ttl=60, no_cache=False, jsonl=False,
+                json=False, total_results=None)
+            with patch('pirate.torrent.find_api',
+                       return_value='https://example.com/api') as find_api, \
+                    patch('pirate.torrent.remote',
+                          return_value=[]) as remote:
+                # the api is only probed the first time
+                for _ in range(2):
+                    self.assertEqual(
+                        pirate.pirate.connect_mirror(
+                            'https://example.com', printer, args),
+                        ([], 'https://example.com'))
+                self.assertEqual(find_api.call_count, 1)
+                self.assertEqual(remote.call_args[1]['mirror'],
+                                 'https://example.com/api')
+
+                # an expired or failing api is probed again
+                args.api_ttl = 0
+                pirate.pirate.connect_mirror(
+                    'https://example.com', printer, args)
+                self.assertEqual(find_api.call_count, 2)
+                args.api_ttl = 60
+                moved = urllib.error.HTTPError(
+                    'https://example.com/api', 404, 'Not Found', {}, None)
+                for error in [moved, ValueError('not json')]:
+                    remote.side_effect = [error, []]
+                    self.assertIsNotNone(pirate.pirate.connect_mirror(
+                        'https://example.com', printer, args))
+                self.assertEqual(find_api.call_count, 4)
+                self.assertEqual(remote.call_count, 7)
+
+                # a mirror that is down isn't probed on top
+                for error in [urllib.error.URLError('refused'),
+                              socket.timeout('timed out')]:
+                    remote.side_effect = [error, []]
+                    self.assertIsNone(pirate.pirate.connect_mirror(
+                        'https://example.com', printer, args))
+                self.assertEqual(find_api.call_count, 4)
+                self.assertEqual(remote.call_count, 9)
+
+    def test_race_mirrors(self):
+        def query(mirror, printer, args, cancel=None):
+            cancels[mirror] = cancel
+            delay, result = mirrors[mirror]
+            time.sleep(delay)
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+        cancels = {}
+
+        args = Namespace(mirror=['slow', 'broken', 'fast', 'late'],
+                         race=0.05, timeout=1, cache_dir=None)
+        mirrors = {
+            'slow': (1, ['slow result']),
+            'broken': (0, IOError('blocked')),
+            'fast': (0.1, ['fast result']),
+            'late': (1, ['late result']),
+        }
+        printer = MagicMock(Printer)
+        with patch('pirate.pirate.query_mirror', side_effect=query) as q:
+            # the broken mirror fails at once so the fast one starts
+            # without waiting and answers before the others
+            self.assertEqual(pirate.pirate.search_mirrors(printer, args),
+                             (['fast result'], 'fast'))
+            self.assertEqual([c[0][0] for c in q.call_args_list],
+                             ['slow', 'broken', 'fast', 'late'])
+            # the answer cancels the mirrors still running, but not
+            # the winner, whose results may still be streaming
+            self.assertTrue(cancels['slow'].is_set())
+            self.assertTrue(cancels['late'].is_set())
+            self.assertFalse(cancels['fast'].is_set())
+
+        # a cancelled mirror doesn't count as failing
+        cancel = threading.Event()
+        cancel.set()
+        with tempfile.TemporaryDirectory() as tmp, \
+                patch('pirate.pirate.query_api', side_effect=IOError):
+            args.cache_dir = tmp
+            for event in [cancel, None]:
+                with self.assertRaises(IOError):
+                    pirate.pirate.query_mirror('slow', printer, args, event)
+            board = pirate.cache.load(tmp, 'mirrors')
+            self.assertEqual(board['slow']['failures'], 1)
+            args.cache_dir = None
+
+        mirrors['fast'] = (0, IOError('down'))
+        mirrors['late'] = (0.1, IOError('down'))
+        with patch('pirate.pirate.query_mirror', side_effect=query), \
+                patch('pirate.pirate.candidate_mirrors',
+                      return_value=iter(['broken', 'fast', 'late'])):
+            with self.assertRaises(IOError):
+                pirate.pirate.search_mirrors(printer, args)
+
+        # other errors are raised by the race instead of hanging it
+        mirrors['broken'] = (0, KeyError('seeders'))
+        with patch('pirate.pirate.query_mirror', side_effect=query), \
+                patch('pirate.pirate.candidate_mirrors',
+                      return_value=iter(['slow', 'broken'])):
+            start = time.monotonic()
+            with self.assertRaises(KeyError):
+                pirate.pirate.search_mirrors(printer, args)
+            self.assertLess(time.monotonic() - start, 0.5)
+            self.assertTrue(cancels['slow'].is_set())
+
+    def test_scoreboard(self):
+        mirrors = ['new', 'slow', 'fast', 'flaky']
+        with tempfile.TemporaryDirectory() as tmp:
+            record = functools.partial(pirate.scoreboard.record, tmp)
+            record('slow', True, 5)
+            record('fast', True, 0.5)
+            record('fast', True, 1)
+            for _ in range(2):
+                record('flaky', False)
+            ready, skipped = pirate.scoreboard.rank(tmp, mirrors, 10)
+            self.assertEqual(ready, ['fast', 'slow', 'new', 'flaky'])
+            self.assertEqual(skipped, [])
+
+            # the third failure in a row opens the circuit
+            record('flaky', False)
+            ready, skipped = pirate.scoreboard.rank(tmp, mirrors, 10)
+            self.assertEqual(ready, ['fast', 'slow', 'new'])
+            self.assertEqual([m for m, _ in skipped], ['flaky'])
+            self.assertAlmostEqual(skipped[0][1], 600, delta=5)
+
+            # once the cooldown is over one retry is let through, it
+            # failing again skips the mirror for twice as long
+            later = time.time() + 601
+            with patch('time.time', return_value=later):
+                self.assertIn('flaky',
+                              pirate.scoreboard.rank(tmp, mirrors, 10)[0])
+                record('flaky', False)
+                skipped = pirate.scoreboard.rank(tmp, mirrors, 10)[1]
+                self.assertAlmostEqual(skipped[0][1], 1200, delta=5)
+            with patch('time.time', return_value=later + 1201):
+                record('flaky', True, 1)
+            ready, skipped = pirate.scoreboard.rank(tmp, mirrors, 10)
+            self.assertIn('flaky', ready)
+
+            # the reply time is a moving average
+            board = pirate.cache.load(tmp, 'mirrors')
+            self.assertAlmostEqual(board['fast']['latency'], 0.65)
+
+            # connect_mirror keeps the score
+            args = Namespace(cache_dir=tmp, api_ttl=0, timeout=1)
+            with patch('pirate.pirate.query_api', side_effect=IOError):
+                pirate.pirate.connect_mirror('new', MagicMock(Printer), args)
+            self.assertEqual(
+                pirate.cache.load(tmp, 'mirrors')['new']['failures'], 1)
+
+    def test_mirror_list_cache(self):
+        def response(*mirrors):
+            f = MagicMock()
+            f.getcode.return_value = 200
+            f.readlines.return_value = [
+                m.encode() for m in ['', '', ''] + list(mirrors)]
+            return f
+
+        with tempfile.TemporaryDirectory() as tmp:
+            args = Namespace(cache_dir=tmp, mirror_list_ttl=60, timeout=1)
+            with patch('urllib.request.urlopen',
+                       return_value=response('https://a')) as urlopen:
+                self.assertEqual(pirate.pirate.mirror_list(args),
+                                 ['https://a'])
+                self.assertEqual(pirate.pirate.mirror_list(args),
+                                 ['https://a'])
+                self.assertEqual(urlopen.call_count, 1)
+
+            # a stale list is used as is while it is downloaded again
+            args.mirror_list_ttl = 0
+            with patch('urllib.request.urlopen',
+                       return_value=response('https://b')), \
+                    patch('threading.Thread') as thread, \
+                    patch('atexit.register') as register:
+                self.assertEqual(pirate.pirate.mirror_list(args),
+                                 ['https://a'])
+                thread.assert_called_once_with(
+                    target=pirate.pirate.refresh_mirror_list,
+                    args=(args,), daemon=True)
+                # the exit waits for the download, up to the timeout
+                register.assert_called_once_with(
+                    thread.return_value.join, 1)
+                pirate.pirate.refresh_mirror_list(args)
+            args.mirror_list_ttl = 60
+            self.assertEqual(pirate.pirate.mirror_list(args), ['https://b'])
+
+            # failing to download keeps the last good copy
+            args.mirror_list_ttl = 0
+            with patch('urllib.request.urlopen',
+                       side_effect=urllib.error.URLError('down')), \
+                    patch('threading.Thread'), patch('atexit.register'):
+                pirate.pirate.refresh_mirror_list(args)
+                self.assertEqual(pirate.pirate.mirror_list(args),
+                                 ['https://b'])
+
+            # and without one the error still comes through
+            args.cache_dir = None
+            with patch('urllib.request.urlopen',
+                       side_effect=urllib.error.URLError('down')):
+                with self.assertRaises(IOError):
+                    pirate.pirate.mirror_list(args)
+
+    def test_jsonl(self):
+        def results():
+            for i in range(3):
+                yield {'name': str(i)}
+                # every result is out before the next is read
+                self.assertEqual(len(stdout.getvalue().splitlines()), i + 1)
+
+        args = pirate.pirate.combine_configs(
+            pirate.pirate.parse_config_file(''),
+            pirate.pirate.parse_args(['term', '--jsonl']))
+        args.cache_dir = None
+        with patch('pirate.torrent.find_api', return_value='api'), \
+                patch('pirate.torrent.iter_remote',
+                      return_value=results()) as iter_remote, \
+                patch('pirate.torrent.remote') as remote, \
+                patch('sys.stdout', io.StringIO()) as stdout, \
+                patch('sys.stderr', io.StringIO()):
+            pirate.pirate.pirate_main(args)
+        remote.assert_not_called()
+        self.assertEqual(iter_remote.call_args[0][4], 'api')
+        self.assertEqual(stdout.getvalue().splitlines(),
+                         ['{"name": "0"}', '{"name": "1"}', '{"name": "2"}'])
+
+    def test_race_jsonl(self):
+        def fetch_page(mode, page, *args):
+            return [{'name': str(page)}]
+
+        args = pirate.pirate.combine_configs(
+            pirate.pirate.parse_config_file(''),
+            pirate.pirate.parse_args(['foo', '--jsonl', '-p', '8', '--race',
+                                      '0.01', '-m', 'http://a']))
+        args.cache_dir = None
+        # the winner keeps fetching pages after the race is over
+        with patch('pirate.torrent.find_api', return_value='api'), \
+                patch('pirate.pirate.mirror_list', return_value=[]), \
+                patch('pirate.torrent.fetch_page', side_effect=fetch_page), \
+                patch('sys.stdout', io.StringIO()) as stdout, \
+                patch('sys.stderr', io.StringIO()):
+            pirate.pirate.pirate_main(args)
+        self.assertEqual(stdout.getvalue().splitlines(),
+                         ['{"name": "%d"}' % i for i in range(1, 9)])
 
 if __name__ == '__main__':
     unittest.main()
@@ -3,9 +3,13 @@ import os
 import unittest
 import json
 import sys
+import io
+import hashlib
+import tempfile
 
 from unittest.mock import patch, call, MagicMock
 from pirate.print import Printer
+import pirate.bencode
 
 
 class TestPrint(unittest.TestCase):
@@ -154,5 +158,38 @@ class TestPrint(unittest.TestCase):
                     call('       61 B b.nfo', color='zebra_0')])
 
 
+    def test_print_saved_file_lists(self):
+        printer = Printer(False)
+        printer.print = MagicMock()
+        info = {'name': 'name', 'piece length': 16384, 'pieces': b'x' * 20,
+                'files': [{'length': 16, 'path': ['readme.txt']},
+                          {'length': 677739464, 'path': ['a.mkv']}]}
+        info_hash = int(hashlib.sha1(
+            pirate.bencode.encode(info)).hexdigest(), 16)
+        result = {'id': '1', 'name': 'name', 'info_hash': info_hash}
+
+        with tempfile.TemporaryDirectory() as folder, \
+                patch('pirate.net.fetch') as fetch:
+            with open(os.path.join(folder, 'name.torrent'), 'wb') as f:
+                f.write(pirate.bencode.encode({'info': info}))
+            printer.file_lists([0], [result], 'example.com', 9, folder)
+            fetch.assert_not_called()
+            printer.print.assert_has_calls([
+                call('Files in name:', color='zebra_1'),
+                call('       16 B name/readme.txt', color='zebra_0'),
+                call('  646.3 MiB name/a.mkv', color='zebra_1')])
+
+            # a torrent with another info hash isn't trusted
+            fetch.return_value = io.StringIO(json.dumps(
+                [{'name': ['b.nfo'], 'size': [61]}]))
+            result['info_hash'] += 1
+            printer.print.reset_mock()
+            printer.file_lists([0], [result], 'example.com', 9, folder)
+            fetch.assert_called_once_with('example.com/f.php?id=1', 9)
+            printer.print.assert_has_calls([
+                call('Files in name:', color='zebra_1'),
+                call('       61 B b.nfo', color='zebra_0')])
+
+
 if __name__ == '__main__':
     unittest.main()
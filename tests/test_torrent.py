@@ -7,9 +7,20 @@ import urllib
 import json
 import os
 import time
+import tempfile
+import random
+import heapq
+import socket
+import collections
+import subprocess
+import threading
+import sys
 
 import pirate.torrent
 import pirate.data
+import pirate.cache
+import pirate.torrents
+import pirate.responses
 from pirate.print import Printer
 from tests import util
 
@@ -37,10 +48,62 @@ class TestTorrent(unittest.TestCase):
         with util.open_data('result.json') as file:
             expected = json.load(file)
         with util.open_data('debian_iso.json') as res:
-            actual = pirate.torrent.parse_page(res)
+            actual = [r.as_dict() for r in pirate.torrent.parse_page(res)]
         json.dump(actual, open('result.json', 'w'))
         self.assertEqual(actual, expected)
 
+    def test_result_fields(self):
+        with util.open_data('debian_iso.json') as res:
+            rows = json.load(res)
+        result = pirate.torrent.TorrentResult(dict(rows[0], extra='x'))
+        self.assertFalse(hasattr(result, '__dict__'))
+        with patch('pirate.torrent.pretty_date') as pretty_date:
+            self.assertEqual(result['seeders'], 1)
+            self.assertEqual(result['extra'], 'x')
+            pretty_date.assert_not_called()
+            result['uploaded']
+            result['uploaded']
+            pretty_date.assert_called_once_with(1294464892)
+        with self.assertRaises(KeyError):
+            result['nothing']
+        result = pirate.torrent.TorrentResult(dict(rows[0], extra='x'))
+        self.assertEqual(json.loads(json.dumps(
+            [result], default=pirate.torrent.TorrentResult.as_dict))[0],
+            dict(result.as_dict(), extra='x'))
+        self.assertEqual(list(result.as_dict())[:13],
+                         list(rows[0]) + ['extra'])
+
+    def test_streaming_parse(self):
+        with util.open_data('debian_iso.json') as res:
+            expected = json.load(res)
+        data = json.dumps(expected, indent=1).encode()
+        for size in [1, 7, pirate.torrent.chunk_size]:
+            with patch('pirate.torrent.chunk_size', size):
+                actual = list(pirate.torrent.iter_json_array(io.BytesIO(data)))
+                self.assertEqual(actual, expected)
+                # numbers split across chunks and multibyte characters
+                self.assertEqual(
+                    list(pirate.torrent.iter_json_array(
+                        io.BytesIO('[123, 4.5, "é€"]'.encode()))),
+                    [123, 4.5, 'é€'])
+
+        # rows come out before the rest of the reply is read
+        f = MagicMock()
+        f.read.side_effect = [b'[{"a": 1},', b' {"a"', b': 2}]']
+        rows = pirate.torrent.iter_json_array(f)
+        self.assertEqual(next(rows), {'a': 1})
+        self.assertEqual(f.read.call_count, 1)
+        self.assertEqual(list(rows), [{'a': 2}])
+
+        # reading stops at the end of the array
+        f = MagicMock()
+        f.read.return_value = b'[]'
+        self.assertEqual(pirate.torrent.parse_page(f), [])
+
+        for bad in [b'', b'[1, 2', b'[1 2]', b'{"a": 1}', b'[1,]', b'\xff']:
+            with self.assertRaises(IOError):
+                list(pirate.torrent.iter_json_array(io.BytesIO(bad)))
+
     def test_parse_category(self):
         category = pirate.torrent.parse_category(MagicMock(Printer), 'Audio')
         self.assertEqual(100, category)
@@ -90,26 +153,123 @@ class TestTorrent(unittest.TestCase):
             with self.assertRaises(out):
                 pirate.torrent.build_request_path(*inp)
 
-    @patch('pirate.torrent.get_torrent')
-    def test_save_torrents(self, get_torrent):
-        with patch('pirate.torrent.open',
-                   mock.mock_open(), create=True) as open_:
+    @patch('pirate.torrent.open_torrent',
+           side_effect=lambda *args: io.BytesIO(b'd4:infode'))
+    def test_save_torrents(self, open_torrent):
+        with tempfile.TemporaryDirectory() as tmp:
             pirate.torrent.save_torrents(
                 MagicMock(Printer), [0],
-                [{'name': 'cool torrent',
+                [{'name': 'cool/torrent',
                   'info_hash': 3735928559,
-                  'magnet': 'magnet:?xt=urn:btih:deadbeef'}], 'path', 9)
-            get_torrent.assert_called_once_with(3735928559, 9)
-            open_.assert_called_once_with('path/cool torrent.torrent', 'wb')
+                  'magnet': 'magnet:?xt=urn:btih:deadbeef'}], tmp, 9)
+            open_torrent.assert_called_once_with(3735928559, 9)
+            self.assertEqual(os.listdir(tmp), ['cool_torrent.torrent'])
+            with open(os.path.join(tmp, 'cool_torrent.torrent'), 'rb') as f:
+                self.assertEqual(f.read(), b'd4:infode')
+            # like a file open() creates, not a private temporary one
+            mode = os.stat(os.path.join(tmp, 'cool_torrent.torrent')).st_mode
+            self.assertEqual(mode & 0o777, 0o666 & ~pirate.torrent.umask)
 
-    @patch('pirate.torrent.get_torrent',
-           side_effect=urllib.error.HTTPError('', '', '', '', io.StringIO()))
-    def test_save_torrents_fail(self, get_torrent):
+    @patch('pirate.torrent.open_torrent',
+           side_effect=urllib.error.HTTPError('', 404, '', '', io.StringIO()))
+    def test_save_torrents_fail(self, open_torrent):
         pirate.torrent.save_torrents(
             MagicMock(Printer), [0],
             [{'name': 'cool torrent',
               'info_hash': 3735928559,
               'magnet': 'magnet:?xt=urn:btih:deadbeef'}], 'path', 9)
+        # missing torrents aren't asked for again
+        self.assertEqual(open_torrent.call_count, 1)
+
+    @patch('pirate.torrent.backoff', 0)
+    def test_save_torrents_retry(self):
+        class Broken(io.BytesIO):
+            def read(self, size=-1):
+                raise socket.timeout('timed out')
+
+        attempts = collections.Counter()
+        replies = {
+            1: [Broken(), io.BytesIO(b'one')],
+            2: [urllib.error.URLError('down')] * 3,
+            3: [urllib.error.HTTPError('', 503, '', '', io.StringIO()),
+                io.BytesIO(b'three')],
+        }
+
+        def open_torrent(info_hash, timeout):
+            reply = replies[info_hash][attempts[info_hash]]
+            attempts[info_hash] += 1
+            if isinstance(reply, Exception):
+                raise reply
+            return reply
+
+        results = [{'name': str(i), 'info_hash': i} for i in (1, 2, 3)]
+        printer = MagicMock(Printer)
+        with tempfile.TemporaryDirectory() as tmp, \
+                patch('pirate.torrent.open_torrent', open_torrent):
+            pirate.torrent.save_torrents(printer, [0, 1, 2], results, tmp, 9)
+            self.assertEqual(sorted(os.listdir(tmp)),
+                             ['1.torrent', '3.torrent'])
+            with open(os.path.join(tmp, '1.torrent'), 'rb') as f:
+                self.assertEqual(f.read(), b'one')
+        self.assertEqual(attempts, {1: 2, 2: 3, 3: 2})
+        printer.print.assert_any_call('Saved 2 of 3 torrents', color='ERROR')
+        printer.print.assert_any_call(
+            '  failed: {} (<urlopen error down>)'.format(
+                os.path.join(tmp, '2.torrent')), color='ERROR')
+
+    def test_torrent_store(self):
+        def open_torrent(info_hash, timeout):
+            opened.append(info_hash)
+            if info_hash == 3:
+                raise urllib.error.HTTPError('', 404, 'Not Found', {},
+                                             io.StringIO())
+            return io.BytesIO(b'torrent %d' % info_hash * 10)
+
+        opened = []
+        results = [{'name': str(i), 'info_hash': i} for i in (1, 2, 3)]
+        with tempfile.TemporaryDirectory() as cache, \
+                tempfile.TemporaryDirectory() as a, \
+                tempfile.TemporaryDirectory() as b, \
+                patch('pirate.torrent.open_torrent', open_torrent):
+            pirate.torrent.save_torrents(MagicMock(Printer), [0, 1, 2],
+                                         results, a, 9, cache)
+            self.assertEqual(sorted(opened), [1, 2, 3])
+
+            # stored torrents and known misses don't go to itorrents
+            pirate.torrent.save_torrents(MagicMock(Printer), [0, 1, 2],
+                                         results, b, 9, cache)
+            self.assertEqual(len(opened), 3)
+            self.assertEqual(sorted(os.listdir(b)),
+                             ['1.torrent', '2.torrent'])
+            with open(os.path.join(b, '2.torrent'), 'rb') as f:
+                self.assertEqual(f.read(), b'torrent 2' * 10)
+            with pirate.torrents.get(cache, 1) as f:
+                self.assertEqual(f.read(), b'torrent 1' * 10)
+            with self.assertRaises(urllib.error.HTTPError):
+                pirate.torrent.download_torrent(
+                    3, os.path.join(b, '3.torrent'), 9, cache)
+            self.assertEqual(len(opened), 3)
+
+            # misses expire
+            with patch('pirate.torrents.missing_ttl', 0):
+                pirate.torrent.save_torrents(MagicMock(Printer), [2],
+                                             results, b, 9, cache)
+            self.assertEqual(opened[3:], [3])
+
+            # the least recently used torrents go first, 1 was read last
+            with patch('pirate.torrents.max_size', 200):
+                pirate.torrent.download_torrent(
+                    4, os.path.join(b, '4.torrent'), 9, cache)
+            self.assertEqual(sorted(os.listdir(os.path.join(
+                cache, 'torrents'))), ['1.torrent', '4.torrent'])
+            self.assertEqual(sorted(pirate.cache.load(cache, 'torrents')),
+                             ['1', '4'])
+
+            # everything is readable by the other users of the directory
+            for name in ['torrents.json', 'missing.json',
+                         'torrents/4.torrent']:
+                mode = os.stat(os.path.join(cache, name)).st_mode
+                self.assertEqual(mode & 0o777, 0o644, name)
 
     def test_save_magnets(self):
         with patch('pirate.torrent.open',
@@ -122,12 +282,12 @@ class TestTorrent(unittest.TestCase):
             open_.assert_called_once_with('path/cool torrent.magnet', 'w')
 
     @patch('urllib.request.urlopen')
-    def test_get_torrent(self, urlopen):
+    def test_open_torrent(self, urlopen):
         class MockRequest():
             add_header = mock.MagicMock()
         request_obj = MockRequest()
         with patch('urllib.request.Request', return_value=request_obj) as req:
-            pirate.torrent.get_torrent(100000000000000, 9)
+            pirate.torrent.open_torrent(100000000000000, 9)
             req.assert_called_once_with(
                 'http://itorrents.org/torrent/5AF3107A4000.torrent',
                 headers=pirate.data.default_headers)
@@ -147,6 +307,7 @@ class TestTorrent(unittest.TestCase):
         class MockResponse():
             read = mock.MagicMock(return_value=b'[]')
             info = mock.MagicMock(return_value=MockInfo())
+            close = mock.MagicMock()
         res_obj = MockResponse()
 
         sort = pirate.torrent.parse_sort(MagicMock(Printer), 10)
@@ -162,6 +323,223 @@ class TestTorrent(unittest.TestCase):
                 res.assert_called_once_with(req_obj, timeout=9)
                 self.assertEqual(results, [])
 
+    def test_remote_pages(self):
+        # later pages answer first, the results still come in page order
+        def urlopen(req, timeout):
+            page = int(req.full_url.split('_')[-1].split('.')[0])
+            time.sleep((5 - page) * 0.01)
+            data = [{'name': 'page {}'.format(page), 'size': '1',
+                     'info_hash': 'AA', 'added': '0', 'seeders': '1',
+                     'leechers': '0', 'category': '100'}]
+            if page == failing:
+                data = b'<html>blocked</html>'
+            else:
+                data = json.dumps(data).encode()
+            response = io.BytesIO(data)
+            response.info = MagicMock()
+            response.info.return_value.get.return_value = None
+            return response
+
+        sort = pirate.data.sorts['Default'][1:]
+        failing = None
+        with patch('urllib.request.urlopen', side_effect=urlopen) as res:
+            results = pirate.torrent.remote(
+                MagicMock(Printer), 4, 0, sort, 'recent',
+                [], 'http://example.com', 9)
+            self.assertEqual(res.call_count, 4)
+        self.assertEqual([r['name'] for r in results],
+                         ['page 1', 'page 2', 'page 3', 'page 4'])
+
+        failing = 3
+        with patch('urllib.request.urlopen', side_effect=urlopen):
+            with self.assertRaises(IOError):
+                pirate.torrent.remote(
+                    MagicMock(Printer), 4, 0, sort, 'recent',
+                    [], 'http://example.com', 9)
+
+    def test_iter_pages_cancel(self):
+        def fetch_page(mode, page, *args):
+            started.append(page)
+            return [page]
+
+        started = []
+        cancel = threading.Event()
+        with patch('pirate.torrent.fetch_page', fetch_page):
+            pages = pirate.torrent.iter_pages(
+                20, 0, 'search', ['x'], 'http://example.com', 9,
+                cancel=cancel)
+            self.assertEqual(next(pages), [1])
+            cancel.set()
+            with self.assertRaises(IOError):
+                list(pages)
+        # only the pages already started before the cancel
+        self.assertEqual(sorted(started),
+                         list(range(1, pirate.torrent.fetch_workers + 1)))
+
+    def test_remote_cancel(self):
+        # Ctrl-C while later pages are still downloading exits right away
+        script = '''if True:
+            import time
+            from unittest.mock import patch
+            import pirate.torrent
+            from pirate.print import Printer
+
+            def fetch_page(mode, page, *args):
+                if page == 1:
+                    time.sleep(0.2)
+                    raise KeyboardInterrupt
+                time.sleep(10)
+                return []
+
+            with patch('pirate.torrent.fetch_page', fetch_page):
+                pirate.torrent.remote(Printer(False), 3, 0, None, 'search',
+                                      ['x'], 'http://example.com', 10)
+        '''
+        start = time.monotonic()
+        process = subprocess.run(
+            [sys.executable, '-c', script], stderr=subprocess.PIPE,
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            timeout=30)
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(process.returncode, 0)
+        self.assertIn(b'Cancelled.', process.stderr)
+
+    def test_sort_results(self):
+        rng = random.Random(0)
+        results = [{'id': i, 'seeders': rng.randint(0, 5),
+                    'raw_size': rng.randint(0, 5),
+                    'name': rng.choice('abc')} for i in range(200)]
+        sorts = [('seeders', True), ('raw_size', False), ('name', True)]
+        for sort in sorts:
+            expected = sorted(results, key=lambda r: r[sort[0]],
+                              reverse=sort[1])
+            self.assertEqual(pirate.torrent.sort_results(sort, results),
+                             expected)
+            for limit in [0, 1, 10, 500]:
+                self.assertEqual(
+                    pirate.torrent.sort_results(sort, results, limit),
+                    expected[:limit])
+
+        # later keys break ties, each in its own direction
+        expected = sorted(results, key=lambda r: r['raw_size'])
+        expected.sort(key=lambda r: r['seeders'], reverse=True)
+        self.assertEqual(
+            pirate.torrent.sort_results(
+                [('seeders', True), ('raw_size', False)], results, 15),
+            expected[:15])
+        expected = sorted(results, key=lambda r: r['name'], reverse=True)
+        expected.sort(key=lambda r: r['seeders'])
+        self.assertEqual(
+            pirate.torrent.sort_results(
+                [('seeders', False), ('name', True)], results),
+            expected)
+
+        self.assertEqual(pirate.torrent.sort_results(None, results, 3),
+                         results[:3])
+
+    def test_merge_pages(self):
+        sort = ('seeders', True)
+        pages = [[{'seeders': s, 'page': p} for s in range(10 - p, 0, -3)]
+                 for p in range(4)]
+        expected = pirate.torrent.sort_results(sort, sum(pages, []))
+        with patch('heapq.merge', wraps=heapq.merge) as merge:
+            self.assertEqual(pirate.torrent.merge_pages(sort, pages),
+                             expected)
+            self.assertEqual(pirate.torrent.merge_pages(sort, pages, 5),
+                             expected[:5])
+            self.assertEqual(merge.call_count, 2)
+
+            # pages out of order are sorted as a whole
+            pages[2].reverse()
+            self.assertEqual(pirate.torrent.merge_pages(sort, pages),
+                             pirate.torrent.sort_results(
+                                 sort, sum(pages, [])))
+            self.assertEqual(merge.call_count, 2)
+
+    def test_iter_remote(self):
+        def fetch_page(mode, page, *args):
+            return ['{}.{}'.format(page, i) for i in range(2)]
+
+        with patch('pirate.torrent.fetch_page',
+                   side_effect=fetch_page) as fetch, \
+                patch('pirate.torrent.fetch_workers', 2):
+            results = pirate.torrent.iter_remote(
+                10, 0, 'recent', [], 'http://example.com', 9)
+            self.assertEqual(next(results), '1.0')
+            # only a window of pages is fetched ahead
+            self.assertLessEqual(fetch.call_count, 2)
+            self.assertEqual(list(results)[-2:], ['10.0', '10.1'])
+            self.assertEqual(fetch.call_count, 10)
+
+    def test_response_cache(self):
+        data = json.dumps([{'name': 'cached', 'size': '1',
+                            'info_hash': 'AA', 'added': '0', 'seeders': '1',
+                            'leechers': '0', 'category': '100'}]).encode()
+
+        def reply(req, timeout):
+            response = io.BytesIO(data)
+            response.info = MagicMock(return_value={'ETag': '"v1"'})
+            return response
+
+        def not_modified(req, timeout):
+            self.assertEqual(req.get_header('If-none-match'), '"v1"')
+            raise urllib.error.HTTPError(req.full_url, 304, 'Not Modified',
+                                         {}, None)
+
+        def fetch():
+            return pirate.torrent.fetch_page(
+                'top', 1, 0, [], 'http://example.com', 9, tmp)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            with patch('urllib.request.urlopen', side_effect=reply) as res:
+                self.assertEqual(fetch()[0]['name'], 'cached')
+                # fresh replies don't go to the mirror at all
+                self.assertEqual(fetch()[0]['name'], 'cached')
+                self.assertEqual(res.call_count, 1)
+
+            # stale ones are revalidated
+            later = time.time() + pirate.responses.ttls['top']
+            with patch('urllib.request.urlopen',
+                       side_effect=not_modified) as res, \
+                    patch('time.time', return_value=later):
+                self.assertEqual(fetch()[0]['name'], 'cached')
+                self.assertEqual(fetch()[0]['name'], 'cached')
+                self.assertEqual(res.call_count, 1)
+
+            # the reply was spooled to its file in the cache as it is
+            entry, body = pirate.responses.get(
+                tmp, 'http://example.com/precompiled/data_top100_all.json')
+            self.assertEqual(body, data)
+            self.assertEqual(os.listdir(os.path.join(tmp, 'responses')),
+                             [entry['file']])
+
+        # a reply that doesn't parse isn't kept, nor its spooled copy
+        data = b'<html>blocked</html>'
+        with tempfile.TemporaryDirectory() as tmp, \
+                patch('urllib.request.urlopen', side_effect=reply):
+            with self.assertRaises(IOError):
+                fetch()
+            self.assertEqual(pirate.cache.load(tmp, 'responses'), {})
+            self.assertEqual(os.listdir(os.path.join(tmp, 'responses')), [])
+
+        def put(tmp, url):
+            f = pirate.responses.spool(tmp)
+            f.write(b'0123456789')
+            pirate.responses.commit(tmp, url, f, None, None)
+
+        # past the size limit the least recently used go first
+        with tempfile.TemporaryDirectory() as tmp:
+            with patch('pirate.responses.max_size', 35):
+                for url in ['a', 'b', 'c']:
+                    put(tmp, url)
+                    time.sleep(0.01)
+                pirate.responses.touch(tmp, 'a')
+                put(tmp, 'd')
+            index = pirate.cache.load(tmp, 'responses')
+            self.assertEqual(sorted(index), ['a', 'c', 'd'])
+            self.assertEqual(
+                len(os.listdir(os.path.join(tmp, 'responses'))), 3)
+
 
 if __name__ == '__main__':
     unittest.main()